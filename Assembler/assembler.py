@@ -1,8 +1,10 @@
 # Assembler for DLS CPU
 
+import functools
+import itertools
 import re
+import struct
 import sys
-import pyperclip
 
 # Register to binary mapping (3-bit values)
 REGISTERS = {
@@ -86,75 +88,243 @@ JUMP_TYPES = {
     'KEY': 0b11,      # jump on key
 }
 
+# Bit fields that depend only on the constants above, packed once at module load
+# DATA3 of a stack instruction: type(2B)/stack(2B)
+STACK_DATA3 = {(op, stack): (op << 2) | stack for op in STACK_OPS.values() for stack in STACK_TYPES.values()}
+# Low nibble of DATA3 for each ALU operation
+ALU_OP_NIBBLES = {op: opnum & 0xF for op, opnum in ALU_OPS.items()}
+# Low nibble of DATA2 for each jump type
+JUMP_TYPE_NIBBLES = {jump_type: jt & 0xF for jump_type, jt in JUMP_TYPES.items()}
+
+# Opcodes and value types used by the per-line parsers, bound to plain names so
+# parsing an instruction doesn't pay for a dict lookup on every constant
+OP_NOP = OPCODES['NOP']
+OP_ALU = OPCODES['ALU']
+OP_STORE = OPCODES['STORE']
+OP_LOAD = OPCODES['LOAD']
+OP_SET = OPCODES['SET']
+OP_JUMP = OPCODES['JUMP']
+OP_DRAW = OPCODES['DRAW']
+OP_CLEARSCREEN = OPCODES['CLEARSCREEN']
+OP_REFRESHSCREEN = OPCODES['REFRESHSCREEN']
+OP_RANDOM = OPCODES['RANDOM']
+OP_STACK = OPCODES['STACK']
+OP_HALT = OPCODES['HALT']
+JT_ALWAYS = JUMP_TYPES[None]
+JT_ZERO = JUMP_TYPES['ZERO']
+JT_CARRY = JUMP_TYPES['CARRY']
+JT_KEY = JUMP_TYPES['KEY']
+VT_REGISTER = VALUE_TYPES['REGISTER']
+VT_BUILTIN = VALUE_TYPES['BUILTIN']
+VT_RAM = VALUE_TYPES['RAM']
+
+# Listing names for every possible value of each field, so the listing indexes a table instead
+# of formatting a fallback name for codes the assembler never emits. Register fields are a
+# nibble in ALU/JUMP/STACK but a whole byte in STORE/LOAD/SET/RANDOM, hence 256 entries
+REGISTER_NAMES = {v: k for k, v in REGISTERS.items()}
+ALU_OP_NAMES = {v: k for k, v in ALU_OPS.items()}
+JUMP_TYPE_NAMES = {v: k for k, v in JUMP_TYPES.items()}
+KEY_NAMES = {v: k for k, v in KEYS.items()}
+STACK_OP_NAMES = {v: k for k, v in STACK_OPS.items()}
+STACK_TYPE_NAMES = {v: k for k, v in STACK_TYPES.items()}
+REGISTER_LISTING = tuple(REGISTER_NAMES.get(code) or f"R{code}" for code in range(256))
+ALU_OP_LISTING = tuple(ALU_OP_NAMES.get(code) or f"OP{code}" for code in range(16))
+JUMP_TYPE_LISTING = tuple(JUMP_TYPE_NAMES.get(code) or "" for code in range(16))
+KEY_LISTING = tuple(KEY_NAMES.get(code) or f"KEY{code}" for code in range(16))
+STACK_OP_LISTING = tuple(STACK_OP_NAMES.get(code) or f"OP{code}" for code in range(4))
+STACK_TYPE_LISTING = tuple(STACK_TYPE_NAMES.get(code) or f"STACK{code}" for code in range(4))
+
+# Layout of one packed instruction: DATA3, DATA2, DATA1, OPCODE
+INSTRUCTION_STRUCT = struct.Struct('4B')
+
+# 8-bit binary text of every byte value, for writing ROM rows by lookup
+BYTE_BITS = tuple(f"{value:08b}" for value in range(256))
+
+# Filler for unused program slots
+NOP_INSTR = (0, 0, 0, OP_NOP)
+
+# Fixed instructions used when expanding function calls and returns
+# PUSH RETURN D (push register D to RETURN stack): extype=0, reg=D
+PUSH_RETURN_D = (STACK_DATA3[(STACK_OPS['PUSH'], STACK_TYPES['RETURN'])], (0 << 4) | REGISTERS['D'], 0, OP_STACK)
+# RETURN: POP RETURN D (pop from RETURN stack to register D), then JUMP D
+# (usereg=1, key=0; reg=D, jmptype=0 unconditional)
+RETURN_INSTRS = (
+    (STACK_DATA3[(STACK_OPS['POP'], STACK_TYPES['RETURN'])], (0 << 4) | REGISTERS['D'], 0, OP_STACK),
+    ((1 << 4) | 0, (REGISTERS['D'] << 4) | 0, 0, OP_JUMP),
+)
+
+# Patterns are compiled once here rather than on every call
+# Operator alternation shared by the binary ALU patterns
+# Longer names come before their prefixes so COMPARE_SIGNED is tried before COMPARE
+ALU_OP_PATTERN = r'[+*/]|NAND|AND|NOR|OR|XNOR|XOR|COMPARE_SIGNED|COMPARE|-'
+
+# ALU binary op, either "val1 op val2 = outreg" (groups 1-4) or
+# "outreg = val1 op val2" (groups 5-8), tried in that order by a single match
+ALU_BINARY_RE = re.compile(r'([A-Z0-9\[\]]+)\s*(' + ALU_OP_PATTERN + r')\s*([A-Z0-9\[\]]+)\s*=\s*([A-Z]+)'
+                           r'|([A-Z]+)\s*=\s*([A-Z0-9\[\]]+)\s*(' + ALU_OP_PATTERN + r')\s*([A-Z0-9\[\]]+)')
+# ALU unary op, either "NOT val1 = outreg" (groups 1-3) or "outreg = NOT val1" (groups 4-6)
+ALU_NOT_RE = re.compile(r'(NOT)\s+([A-Z0-9\[\]]+)\s*=\s*([A-Z]+)'
+                        r'|([A-Z]+)\s*=\s*(NOT)\s+([A-Z0-9\[\]]+)')
+
+# Operators usable in the binary ALU forms (NOT is unary only)
+BINARY_ALU_OPS = frozenset(ALU_OPS) - {'NOT'}
+# Characters an ALU operand token may consist of, as in the patterns above
+OPERAND_CHARS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789[]'
+
+# Comparison operators supported in IF conditions
+COMPARISON_OPS = ('==', '!=', '<=', '>=', '<', '>')
+
+# Jumps emitted after the COMPARE of an IF statement, as (jump type bits, target block).
+# COMPARE sets the zero flag if equal and the carry flag if left < right. The then
+# block follows the jumps, so when the last jump isn't unconditional it falls through
+IF_JUMPS = {
+    # Jump to then block if zero (equal), otherwise fall through to else
+    '==': ((JT_ZERO, 'THEN'), (JT_ALWAYS, 'ELSE')),
+    # Jump to else if zero (equal), fall through to then if not equal
+    '!=': ((JT_ZERO, 'ELSE'),),
+    # Jump to then if carry (left < right), otherwise fall through to else
+    '<': ((JT_CARRY, 'THEN'), (JT_ALWAYS, 'ELSE')),
+    # Jump to else if carry (left < right), fall through to then if not
+    '>=': ((JT_CARRY, 'ELSE'),),
+    # left > right means NOT(left < right OR left == right)
+    # Jump to else if zero (equal) or carry (less than)
+    '>': ((JT_ZERO, 'ELSE'), (JT_CARRY, 'ELSE')),
+    # left <= right means left < right OR left == right
+    # Jump to then if zero (equal) or carry (less than)
+    '<=': ((JT_ZERO, 'THEN'), (JT_CARRY, 'THEN'), (JT_ALWAYS, 'ELSE')),
+}
+
+# Source of unique suffixes for the labels generated by each IF statement
+IF_LABEL_IDS = itertools.count()
+
+# Literals such as 0, 1 or 0XFF repeat across SET, STORE, DRAW and jump operands,
+# so each distinct token is converted once
+@functools.lru_cache(maxsize=256)
 def parse_number(token):
-    token = token.upper()
+    """Parse a decimal, 0x hex or 0b binary literal (tokens arrive uppercased)"""
+    # Plain decimal literals are by far the most common, so settle them first
+    if token.isdecimal():
+        return int(token)
     if token.startswith('0X'):
         return int(token, 16)
     if token.startswith('0B'):
         return int(token, 2)
+    # Anything else (signs, underscores) is left to int() to accept or reject
     try:
         return int(token)
     except ValueError:
         raise ValueError(f"invalid literal for int() with base 10: '{token}'")
 
-def first_pass(lines):
+def clean_lines(lines):
+    """Strip comments and surrounding whitespace from every source line
+    
+    Comments run from // to the end of the line, so a plain partition is enough.
+    """
+    return [line.partition('//')[0].strip() for line in lines]
+
+def split_labels(cleaned):
+    """Split every label line into its uppercased label and the text after the colon.
+    
+    Lines without a colon get None, so the passes can tell labels apart by index.
+    """
+    label_defs = []
+    for clean_line in cleaned:
+        label_part, colon, rest_of_line = clean_line.partition(':')
+        if colon:
+            label_defs.append((label_part.strip().upper(), rest_of_line.strip().upper()))
+        else:
+            label_defs.append(None)
+    return label_defs
+
+def match_if_blocks(upper_lines):
+    """Pair every IF line with its top-level ELSE lines and its matching END.
+    
+    Returns {if_index: (else_indices, end_index)}; IFs without an END are left out.
+    """
+    if_blocks = {}
+    open_ifs = []  # Stack of (if_index, else_indices) for IFs still waiting for their END
+    for j, line in enumerate(upper_lines):
+        if line.startswith('IF '):
+            open_ifs.append((j, []))
+        elif line == 'ELSE' and open_ifs:
+            open_ifs[-1][1].append(j)
+        elif line == 'END' and open_ifs:
+            if_index, else_indices = open_ifs.pop()
+            if_blocks[if_index] = (tuple(else_indices), j)
+    return if_blocks
+
+def first_pass(upper_lines, label_defs):
     """First pass to identify functions and fake functions only"""
     functions = {}
-    fake_functions = {}
+    fake_functions = {}  # Fake function name -> list of its instruction lines
+    fake_starts = {}  # Fake function name -> index of its label line
     functions_with_return = set()  # Track which functions have RETURN statements
     
+    # What ends a function look-ahead on each line: a RETURN, an unconditional jump
+    # (JUMP without IF condition) or another label
+    stop_kinds = []
+    for clean_upper in upper_lines:
+        kind = None
+        if clean_upper == 'RETURN':
+            kind = 'RETURN'
+        elif clean_upper.startswith('JUMP ') and ' IF ' not in clean_upper:
+            parts = clean_upper.split()
+            # Make sure it's not a conditional jump (ZERO, CARRY, KEY)
+            if len(parts) == 2 or (len(parts) > 2 and parts[2] not in ['ZERO', 'CARRY', 'KEY']):
+                kind = 'JUMP'
+        if kind is None and ':' in clean_upper:
+            kind = 'LABEL'
+        stop_kinds.append(kind)
+    
+    # Index of the first look-ahead stop at or after each line, so a label can find
+    # it in one step instead of rescanning the lines below it
+    look_ahead_stops = [len(upper_lines)] * (len(upper_lines) + 1)
+    # Likewise the index of the next label at or after each line, which ends a fake function body
+    next_label = [len(upper_lines)] * (len(upper_lines) + 1)
+    for i in range(len(upper_lines) - 1, -1, -1):
+        look_ahead_stops[i] = i if stop_kinds[i] else look_ahead_stops[i + 1]
+        next_label[i] = i if ':' in upper_lines[i] else next_label[i + 1]
+    
     # First, identify functions and fake functions
-    for i, line in enumerate(lines):
-        clean_line = re.sub(r'//.*', '', line).strip()
+    for i, clean_line in enumerate(upper_lines):
         if not clean_line:
             continue
             
-        if ':' in clean_line:
-            label_part = clean_line.split(':')[0].strip()
+        if label_defs[i]:
+            label_part, rest_of_line = label_defs[i]
             
             # Check for function syntax [function_name]: or [function_name]: fake
             if label_part.startswith('[') and label_part.endswith(']'):
-                func_name = label_part[1:-1].upper()
+                func_name = label_part[1:-1]
                 # Check if it's a fake function
-                rest_of_line = clean_line.split(':', 1)[1].strip().upper()
                 if rest_of_line == 'FAKE':
-                    fake_functions[func_name] = {'start_line': i, 'instructions': []}
+                    fake_starts[func_name] = i
                 else:
                     # Functions will be placed after HALT, we'll calculate their addresses later
                     functions[func_name] = None  # Placeholder
             else:
                 # Check if it's a fake function without brackets (label: fake)
-                rest_of_line = clean_line.split(':', 1)[1].strip().upper()
                 if rest_of_line == 'FAKE':
-                    func_name = label_part.upper()
-                    fake_functions[func_name] = {'start_line': i, 'instructions': []}
+                    func_name = label_part
+                    fake_starts[func_name] = i
                 else:
                     # Check if this looks like a function (contains "Loop" or common function patterns)
                     # or if it has instructions following it that suggest it's a function
-                    func_name = label_part.upper()
+                    func_name = label_part
                     
                     # Look ahead to see if this should be treated as a function
                     is_function = False
                     has_return = False
                     
-                    # Look ahead to see if it has a return statement or ends with an unconditional jump
-                    for j in range(i + 1, min(i + 20, len(lines))):  # Look ahead up to 20 lines
-                        next_line = re.sub(r'//.*', '', lines[j]).strip()
-                        if not next_line:
-                            continue
-                        if next_line.upper() == 'RETURN':
+                    # Look ahead (up to 20 lines) to see if it has a return statement or ends
+                    # with an unconditional jump before hitting another label
+                    j = look_ahead_stops[i + 1]
+                    if j < min(i + 20, len(upper_lines)):
+                        if stop_kinds[j] == 'RETURN':
                             is_function = True
                             has_return = True
-                            break
-                        # Check if it ends with an unconditional jump (JUMP without IF condition)
-                        if next_line.upper().startswith('JUMP ') and ' IF ' not in next_line.upper():
-                            parts = next_line.upper().split()
-                            # Make sure it's not a conditional jump (ZERO, CARRY, KEY)
-                            if len(parts) == 2 or (len(parts) > 2 and parts[2] not in ['ZERO', 'CARRY', 'KEY']):
-                                is_function = True
-                                break
-                        if ':' in next_line:  # Hit another label
-                            break
+                        elif stop_kinds[j] == 'JUMP':
+                            is_function = True
                     
                     # Only treat as function if it has explicit function patterns AND has return/jump behavior
                     if not is_function:
@@ -169,518 +339,558 @@ def first_pass(lines):
                             functions_with_return.add(func_name)
     
     # Collect fake function instructions and check for RETURN statements in fake functions
-    for func_name, func_info in fake_functions.items():
-        start_line = func_info['start_line']
-        instructions = []
-        has_return = False
+    for func_name, start_line in fake_starts.items():
+        # Instructions run until the next function/label or end of file
+        # Kept as a tuple so expansions can be cached on the body
+        instructions = tuple(line for line in upper_lines[start_line + 1:next_label[start_line + 1]] if line)
         
-        # Find instructions until next function/label or end of file
-        for i in range(start_line + 1, len(lines)):
-            line = re.sub(r'//.*', '', lines[i]).strip()
-            if not line:
-                continue
-            
-            # Stop if we hit another function or label
-            if ':' in line:
-                break
-                
-            instructions.append(line)
-            if line.upper() == 'RETURN':
-                has_return = True
-        
-        func_info['instructions'] = instructions
-        if has_return:
+        fake_functions[func_name] = instructions
+        if 'RETURN' in instructions:
             functions_with_return.add(func_name)
     
     return functions, fake_functions, functions_with_return
 
-def count_instruction_increment(line, fake_functions, functions_with_return=None):
-    """Count how many machine instructions a single source line will generate"""
+# Source lines that always produce the same number of machine instructions:
+# RETURN generates 2 (POP + JUMP), and ELSE/END are fake and generate none
+FIXED_INCREMENTS = {'RETURN': 2, 'ELSE': 0, 'END': 0}
+
+def bracketed_name(line):
+    """Return the first non-empty [name] in a line, e.g. the function in JUMP [name], or None"""
+    start = line.find('[')
+    while start >= 0:
+        end = line.find(']', start + 1)
+        if end < 0:
+            return None
+        if end > start + 1:
+            return line[start + 1:end]
+        # An empty [] names nothing; look for the next bracket
+        start = line.find('[', start + 1)
+    return None
+
+def fake_function_size(func_name, fake_functions, functions_with_return, fake_sizes):
+    """Count the machine instructions a fake function expands to, once per name
+    
+    The total is kept in fake_sizes, so repeated calls (including calls from other
+    fake functions) reuse it instead of recounting the whole body.
+    """
+    size = fake_sizes.get(func_name)
+    if size is None:
+        size = 0
+        for instr in fake_functions[func_name]:
+            size += count_instruction_increment(instr, fake_functions, functions_with_return, fake_sizes)
+        fake_sizes[func_name] = size
+    return size
+
+def count_instruction_increment(line, fake_functions, functions_with_return=None, fake_sizes=None):
+    """Count how many machine instructions a single (cleaned, uppercased) source line will generate"""
     if functions_with_return is None:
         functions_with_return = set()
+    if fake_sizes is None:
+        fake_sizes = {}
     
-    line = line.strip().upper()
-    
-    # RETURN generates 2 instructions (LOAD + JUMP)
-    if line == 'RETURN':
-        return 2
+    # Whole-line keywords with a fixed size
+    fixed = FIXED_INCREMENTS.get(line)
+    if fixed is not None:
+        return fixed
     
-    # IF statements are fake and don't generate instructions directly
-    if line.startswith('IF ') or line == 'ELSE' or line == 'END':
-        return 0
+    # Only jumps can vary in size; IF statements are fake and don't generate
+    # instructions directly, and everything else is a single instruction
+    if not line.startswith('JUMP'):
+        return 0 if line.startswith('IF ') else 1
     
     # Function calls - check if they need return address handling
-    if line.startswith('JUMP') and '[' in line and ']' in line:
-        func_name_match = re.search(r'\[([^\]]+)\]', line)
-        if func_name_match:
-            func_name = func_name_match.group(1).upper()
-            if func_name in fake_functions:
-                # Fake function - count its instructions recursively
-                total_count = 0
-                for instr in fake_functions[func_name]['instructions']:
-                    total_count += count_instruction_increment(instr, fake_functions, functions_with_return)
-                return total_count
+    func_name = bracketed_name(line)
+    if func_name is not None:
+        if func_name in fake_functions:
+            # Fake function - count its instructions recursively
+            return fake_function_size(func_name, fake_functions, functions_with_return, fake_sizes)
+        else:
+            # Real function call - only generates 2 instructions if function has RETURN
+            if func_name in functions_with_return:
+                return 2  # push return + jump
             else:
-                # Real function call - only generates 2 instructions if function has RETURN
-                if func_name in functions_with_return:
-                    return 2  # push return + jump
-                else:
-                    return 1  # just jump
+                return 1  # just jump
     
     # Function calls without brackets to fake functions
-    if line.startswith('JUMP'):
-        parts = line.split()
-        if len(parts) >= 2:
-            target = parts[1].upper()
-            if target in fake_functions:
-                # Fake function - count its instructions recursively
-                total_count = 0
-                for instr in fake_functions[target]['instructions']:
-                    total_count += count_instruction_increment(instr, fake_functions, functions_with_return)
-                return total_count
+    parts = line.split()
+    if len(parts) >= 2:
+        target = parts[1]
+        if target in fake_functions:
+            # Fake function - count its instructions recursively
+            return fake_function_size(target, fake_functions, functions_with_return, fake_sizes)
+        else:
+            # Real function call - only generates 2 instructions if function has RETURN
+            if target in functions_with_return:
+                return 2  # push return + jump
             else:
-                # Real function call - only generates 2 instructions if function has RETURN
-                if target in functions_with_return:
-                    return 2  # push return + jump
-                else:
-                    return 1  # just jump
+                return 1  # just jump
     
-    # Most other instructions generate 1 machine instruction
+    # A JUMP without a target still generates 1 machine instruction
     return 1
 
+# Operands like A, 0 or [16] recur throughout a program and the result depends only
+# on the token, so each distinct one is parsed once
+@functools.lru_cache(maxsize=4096)
 def parse_value(value_str):
-    """Parse a value which could be a register, a direct value, or a memory address."""
-    value_str = value_str.strip().upper()
+    """Parse a value which could be a register, a direct value, or a memory address.
     
+    Operands arrive as single stripped, uppercased tokens (ALU words or IF condition sides).
+    """
     # Check if it's a register
     if value_str in REGISTERS:
-        return (VALUE_TYPES['REGISTER'], REGISTERS[value_str])
+        return (VT_REGISTER, REGISTERS[value_str])
     
     # Check if it's a memory address (indicated by [])
     if value_str.startswith('[') and value_str.endswith(']'):
         addr = parse_number(value_str[1:-1])
-        return (VALUE_TYPES['RAM'], addr & 0xFF)
+        return (VT_RAM, addr & 0xFF)
     
     # Otherwise, it's a built-in value (constant)
     try:
         value = parse_number(value_str)
-        return (VALUE_TYPES['BUILTIN'], value & 0xFF)
+        return (VT_BUILTIN, value & 0xFF)
     except ValueError:
         raise ValueError(f"Invalid value: {value_str}")
 
-def parse_instruction(line, labels, functions=None, line_labels=None, call_stack_ptr=None, fake_functions=None):
-    line = line.strip().upper()
-    line = re.sub(r'//.*', '', line)
-    if not line or line.endswith(':'):
-        return None
-
-    # HALT
-    if line == 'HALT':
-        return (0, 0, 0, OPCODES['HALT'])
-    
-    # RETURN - Pop return address from stack and jump to it
-    if line == 'RETURN':
-        # Return a special marker that the assembler will handle
-        # This will be expanded to: POP FROM RETURN TO X, JUMP X
-        return ('RETURN', 0, 0, 'SPECIAL')
-
-    # NOP
-    if line == 'NOP':
-        return (0, 0, 0, OPCODES['NOP'])
-
-    # CLEARSCREEN / REFRESHSCREEN
-    if line == 'CLEARSCREEN':
-        return (0, 0, 0, OPCODES['CLEARSCREEN'])
-    if line == 'REFRESHSCREEN':
-        return (0, 0, 0, OPCODES['REFRESHSCREEN'])
-
+def parse_random(line, parts, labels, functions, line_labels, fake_functions):
     # RANDOM R
-    if line.startswith('RANDOM'):
-        parts = line.split()
-        if len(parts) != 2:
-            raise ValueError(f"RANDOM instruction requires exactly one register parameter, got {len(parts)-1}: {line}")
-        reg = parts[1]
-        if reg.upper() not in REGISTERS:
-            raise ValueError(f"Invalid register in RANDOM instruction: {reg}")
-        reg_code = REGISTERS[reg.upper()]
-        # DATA3: null, DATA2: register, DATA1: null
-        return (0, reg_code, 0, OPCODES['RANDOM'])
+    if len(parts) != 2:
+        raise ValueError(f"RANDOM instruction requires exactly one register parameter, got {len(parts)-1}: {line}")
+    reg = parts[1]
+    if reg not in REGISTERS:
+        raise ValueError(f"Invalid register in RANDOM instruction: {reg}")
+    reg_code = REGISTERS[reg]
+    # DATA3: null, DATA2: register, DATA1: null
+    return (0, reg_code, 0, OP_RANDOM)
 
+def parse_push(line, parts, labels, functions, line_labels, fake_functions):
     # PUSH [stack name] [value] - Push value onto stack
-    if line.startswith('PUSH'):
-        parts = line.split()
-        # Default to GENERAL stack if not specified
-        stack_type = STACK_TYPES['GENERAL']
-        value = 0
-        reg = 0xF  # 0xF means no register (use data instead)
-        
-        if len(parts) >= 3:
-            # PUSH [stack name] [value/register]
-            stack_name = parts[1].upper()
-            if stack_name in STACK_TYPES:
-                stack_type = STACK_TYPES[stack_name]
-                value_str = parts[2].upper()
-            else:
-                # First argument is not a stack name, treat as PUSH [value/register] with default stack
-                value_str = parts[1].upper()
-            
-            if value_str in REGISTERS:
-                # Push from register
-                reg = REGISTERS[value_str]
-                value = 0  # Not used when pushing from register
-            else:
-                # Push literal value
-                value = parse_number(value_str) & 0xFF
-                reg = 0xF  # No register
-        elif len(parts) >= 2:
-            # PUSH [value/register] (default stack)
-            value_str = parts[1].upper()
-            if value_str in REGISTERS:
-                # Push from register
-                reg = REGISTERS[value_str]
-                value = 0  # Not used when pushing from register
-            else:
-                # Push literal value
-                value = parse_number(value_str) & 0xFF
-                reg = 0xF  # No register
+    # Default to GENERAL stack if not specified
+    stack_type = STACK_TYPES['GENERAL']
+    value = 0
+    reg = 0xF  # 0xF means no register (use data instead)
+    
+    if len(parts) >= 3:
+        # PUSH [stack name] [value/register]
+        stack_name = parts[1]
+        if stack_name in STACK_TYPES:
+            stack_type = STACK_TYPES[stack_name]
+            value_str = parts[2]
+        else:
+            # First argument is not a stack name, treat as PUSH [value/register] with default stack
+            value_str = parts[1]
         
-        # According to opcodes.txt:
-        # DATA3: type(2B)/stack(2B) - push type in upper 2 bits, stack type in lower 2 bits
-        # DATA2: extype/reg - extype in upper nibble (0 for now), reg in lower nibble
-        # DATA1: data - the value to push (if reg is 0xF) or unused (if pushing from register)
-        data3 = (STACK_OPS['PUSH'] << 2) | stack_type
-        data2 = (0 << 4) | reg  # extype=0, reg in lower nibble
-        data1 = value
-        return (data3, data2, data1, OPCODES['STACK'])
+        if value_str in REGISTERS:
+            # Push from register
+            reg = REGISTERS[value_str]
+            value = 0  # Not used when pushing from register
+        else:
+            # Push literal value
+            value = parse_number(value_str) & 0xFF
+            reg = 0xF  # No register
+    elif len(parts) >= 2:
+        # PUSH [value/register] (default stack)
+        value_str = parts[1]
+        if value_str in REGISTERS:
+            # Push from register
+            reg = REGISTERS[value_str]
+            value = 0  # Not used when pushing from register
+        else:
+            # Push literal value
+            value = parse_number(value_str) & 0xFF
+            reg = 0xF  # No register
+    
+    # According to opcodes.txt:
+    # DATA3: type(2B)/stack(2B) - push type in upper 2 bits, stack type in lower 2 bits
+    # DATA2: extype/reg - extype in upper nibble (0 for now), reg in lower nibble
+    # DATA1: data - the value to push (if reg is 0xF) or unused (if pushing from register)
+    data3 = STACK_DATA3[(STACK_OPS['PUSH'], stack_type)]
+    data2 = (0 << 4) | reg  # extype=0, reg in lower nibble
+    data1 = value
+    return (data3, data2, data1, OP_STACK)
 
+def parse_pop(line, parts, labels, functions, line_labels, fake_functions):
     # POP [stack name] [register name] - Pop value from stack to register
-    if line.startswith('POP'):
-        parts = line.split()
-        # Default to GENERAL stack if not specified
-        stack_type = STACK_TYPES['GENERAL']
-        reg = None
-        
-        if len(parts) >= 3:
-            # POP [stack name] [register]
-            stack_name = parts[1].upper()
-            if stack_name in STACK_TYPES:
-                stack_type = STACK_TYPES[stack_name]
-                reg = REGISTERS[parts[2]]
-            else:
-                # First argument is not a stack name, treat as POP [register] with default stack
-                reg = REGISTERS[parts[1]]
-        elif len(parts) >= 2:
-            # POP [register] (default stack)
+    # Default to GENERAL stack if not specified
+    stack_type = STACK_TYPES['GENERAL']
+    reg = None
+    
+    if len(parts) >= 3:
+        # POP [stack name] [register]
+        stack_name = parts[1]
+        if stack_name in STACK_TYPES:
+            stack_type = STACK_TYPES[stack_name]
+            reg = REGISTERS[parts[2]]
+        else:
+            # First argument is not a stack name, treat as POP [register] with default stack
             reg = REGISTERS[parts[1]]
-        
-        if reg is None:
-            raise ValueError(f"Invalid POP instruction: {line}")
-        
-        # According to opcodes.txt:
-        # DATA3: type(2B)/stack(2B) - pop type in upper 2 bits, stack type in lower 2 bits
-        # DATA2: extype/reg - extype in upper nibble (0 for now), reg in lower nibble
-        # DATA1: data - unused for pop, set to 0
-        data3 = (STACK_OPS['POP'] << 2) | stack_type
-        data2 = (0 << 4) | reg  # extype=0, reg in lower nibble
-        data1 = 0
-        return (data3, data2, data1, OPCODES['STACK'])
+    elif len(parts) >= 2:
+        # POP [register] (default stack)
+        reg = REGISTERS[parts[1]]
+    
+    if reg is None:
+        raise ValueError(f"Invalid POP instruction: {line}")
+    
+    # According to opcodes.txt:
+    # DATA3: type(2B)/stack(2B) - pop type in upper 2 bits, stack type in lower 2 bits
+    # DATA2: extype/reg - extype in upper nibble (0 for now), reg in lower nibble
+    # DATA1: data - unused for pop, set to 0
+    data3 = STACK_DATA3[(STACK_OPS['POP'], stack_type)]
+    data2 = (0 << 4) | reg  # extype=0, reg in lower nibble
+    data1 = 0
+    return (data3, data2, data1, OP_STACK)
 
+def parse_set(line, parts, labels, functions, line_labels, fake_functions):
     # SET R TO N
-    if line.startswith('SET'):
-        parts = line.split()
-        if len(parts) < 4 or parts[2].upper() != 'TO':
-            raise ValueError(f"SET instruction must be in format 'SET R TO N', got: {line}")
-        if parts[1].upper() not in REGISTERS:
-            raise ValueError(f"Invalid register in SET instruction: {parts[1]}")
-        reg = REGISTERS[parts[1].upper()]
-        value = parse_number(parts[-1])
-        
-        # DATA3: null, DATA2: register, DATA1: data/value
-        return (0, reg, value & 0xFF, OPCODES['SET'])
+    if len(parts) < 4 or parts[2] != 'TO':
+        raise ValueError(f"SET instruction must be in format 'SET R TO N', got: {line}")
+    if parts[1] not in REGISTERS:
+        raise ValueError(f"Invalid register in SET instruction: {parts[1]}")
+    reg = REGISTERS[parts[1]]
+    value = parse_number(parts[-1])
+    
+    # DATA3: null, DATA2: register, DATA1: data/value
+    return (0, reg, value & 0xFF, OP_SET)
 
+def parse_store(line, parts, labels, functions, line_labels, fake_functions):
     # STORE R INTO ADDR - Stores register into RAM address
-    if line.startswith('STORE') and 'INTO' in line:
-        parts = line.split()
-        if parts[1].isalpha():  # STORE R INTO ADDR
-            reg = REGISTERS[parts[1]]
-            addr = parse_number(parts[3])
-            # DATA3: null, DATA2: register, DATA1: address
-            return (0, reg, addr & 0xFF, OPCODES['STORE'])
-        else:  # STORE ADDR INTO R (LOAD)
-            addr = parse_number(parts[1])
-            reg = REGISTERS[parts[3]]
-            # DATA3: null, DATA2: output register, DATA1: address
-            return (0, reg, addr & 0xFF, OPCODES['LOAD'])
-
-    # LOAD ADDR INTO R - Alternative syntax for STORE ADDR INTO R
-    if line.startswith('LOAD'):
-        parts = line.split()
+    if 'INTO' not in line:
+        raise ValueError(f"Unknown instruction: {line}")
+    if parts[1] in REGISTERS:  # STORE R INTO ADDR
+        reg = REGISTERS[parts[1]]
+        addr = parse_number(parts[3])
+        # DATA3: null, DATA2: register, DATA1: address
+        return (0, reg, addr & 0xFF, OP_STORE)
+    else:  # STORE ADDR INTO R (LOAD)
         addr = parse_number(parts[1])
         reg = REGISTERS[parts[3]]
         # DATA3: null, DATA2: output register, DATA1: address
-        return (0, reg, addr & 0xFF, OPCODES['LOAD'])
+        return (0, reg, addr & 0xFF, OP_LOAD)
+
+def parse_load(line, parts, labels, functions, line_labels, fake_functions):
+    # LOAD ADDR INTO R - Alternative syntax for STORE ADDR INTO R
+    addr = parse_number(parts[1])
+    reg = REGISTERS[parts[3]]
+    # DATA3: null, DATA2: output register, DATA1: address
+    return (0, reg, addr & 0xFF, OP_LOAD)
+
+def parse_draw_param(param):
+    """Parse one DRAW operand: a register code or a 4-bit literal"""
+    if param in REGISTERS:
+        # Use register code as the value - this might need hardware support
+        # or we might need to expand this into load + draw instructions
+        return REGISTERS[param]
+    else:
+        return parse_number(param) & 0xF
 
+def parse_draw(line, parts, labels, functions, line_labels, fake_functions):
     # DRAW X Y R G B - can use registers or literal values
-    if line.startswith('DRAW'):
-        parts = line.split()
-        
-        # Validate parameter count
-        if len(parts) != 6:
-            raise ValueError(f"DRAW instruction requires exactly 5 parameters (X Y R G B), got {len(parts)-1}: {line}")
-        
-        # For DRAW instruction, if parameters are registers, we encode them differently
-        # The hardware expects literal values, but if registers are used, we need to
-        # handle this as a special case or expand it into multiple instructions
-        
-        # For now, let's assume all parameters are literal values
-        # If they're registers, we'll use the register codes as placeholder values
-        def parse_draw_param(param):
-            param = param.upper()
-            if param in REGISTERS:
-                # Use register code as the value - this might need hardware support
-                # or we might need to expand this into load + draw instructions
-                return REGISTERS[param]
-            else:
-                return parse_number(param) & 0xF
-        
-        x = parse_draw_param(parts[1]) & 0xF  # 4-bit value
-        y = parse_draw_param(parts[2]) & 0xF  # 4-bit value
-        r = parse_draw_param(parts[3]) & 0xF  # 4-bit value
-        g = parse_draw_param(parts[4]) & 0xF  # 4-bit value
-        b = parse_draw_param(parts[5]) & 0xF  # 4-bit value
-        
-        # According to opcodes.txt:
-        # DATA3: addrs/R/G/Btype(1B)/B - address in upper nibble, B in lower nibble
-        # DATA2: R/G - R in upper nibble, G in lower nibble  
-        # DATA1: addrs - Y in upper nibble, X in lower nibble
-        data3 = (0 << 4) | b  # address=0 (not used for pixel drawing), B in lower nibble
-        data2 = (r << 4) | g
-        data1 = (y << 4) | x
-        
-        return (data3, data2, data1, OPCODES['DRAW'])
+    # Validate parameter count
+    if len(parts) != 6:
+        raise ValueError(f"DRAW instruction requires exactly 5 parameters (X Y R G B), got {len(parts)-1}: {line}")
+    
+    # For DRAW instruction, if parameters are registers, we encode them differently
+    # The hardware expects literal values, but if registers are used, we need to
+    # handle this as a special case or expand it into multiple instructions
+    
+    # For now, let's assume all parameters are literal values
+    # If they're registers, we'll use the register codes as placeholder values
+    x = parse_draw_param(parts[1]) & 0xF  # 4-bit value
+    y = parse_draw_param(parts[2]) & 0xF  # 4-bit value
+    r = parse_draw_param(parts[3]) & 0xF  # 4-bit value
+    g = parse_draw_param(parts[4]) & 0xF  # 4-bit value
+    b = parse_draw_param(parts[5]) & 0xF  # 4-bit value
+    
+    # According to opcodes.txt:
+    # DATA3: addrs/R/G/Btype(1B)/B - address in upper nibble, B in lower nibble
+    # DATA2: R/G - R in upper nibble, G in lower nibble  
+    # DATA1: addrs - Y in upper nibble, X in lower nibble
+    data3 = (0 << 4) | b  # address=0 (not used for pixel drawing), B in lower nibble
+    data2 = (r << 4) | g
+    data1 = (y << 4) | x
+    
+    return (data3, data2, data1, OP_DRAW)
 
+def parse_jump(line, parts, labels, functions, line_labels, fake_functions):
     # JUMP label IF condition
-    if line.startswith('JUMP'):
-        parts = line.split()
-        label = parts[1]
-        
-        # Check for jump condition
-        jump_type = None
-        key = 0
-        if len(parts) > 2:
-            # Handle both "JUMP label IF condition" and "JUMP label condition" syntax
-            condition_index = 3 if parts[2].upper() == 'IF' else 2
-            if len(parts) > condition_index:
-                condition = parts[condition_index].upper()
-                if condition in JUMP_TYPES:
-                    jump_type = condition
-                elif condition == 'ZERO':
-                    jump_type = 'ZERO'
-                elif condition == 'CARRY':
-                    jump_type = 'CARRY'
-                elif condition == 'KEY':
-                    jump_type = 'KEY'
-                    if len(parts) > condition_index + 1:
-                        key = KEYS.get(parts[condition_index + 1].upper(), 0)
-                elif condition == 'ANY' and len(parts) > condition_index + 1 and parts[condition_index + 1].upper() == 'KEY':
-                    # Handle "ANY KEY" case - use jump type 0xFF
-                    jump_type = None  # Will be set to 0xFF below
-                    key = 0
-        
-        # Determine target address - this is the instruction address where we want to jump
-        addr = None
-        is_function_call = False
-        
-        # Check if it's a line number (L1, L2, etc.)
-        if line_labels and label.upper().startswith('L') and label.upper()[1:].isdigit():
-            line_num = int(label.upper()[1:])
-            if f'L{line_num}' in line_labels:
-                addr = line_labels[f'L{line_num}']
-            else:
-                raise ValueError(f"Unknown line label: '{label}'. Available line labels: {', '.join(sorted(line_labels.keys()))}")
-        # Check if it's a function call (with or without brackets)
-        elif functions and label.upper() in functions:
-            addr = functions[label.upper()]
+    label = parts[1]
+    # A bracketed target names a function; the bare name is what gets looked up
+    bracketed = label.startswith('[') and label.endswith(']')
+    
+    # Check for jump condition
+    jump_type = None
+    key = 0
+    any_key = False
+    if len(parts) > 2:
+        # "ANY KEY" can follow the target directly or after one more word (e.g. IF)
+        any_key = parts[2:4] == ['ANY', 'KEY'] or parts[3:5] == ['ANY', 'KEY']
+        # Handle both "JUMP label IF condition" and "JUMP label condition" syntax
+        condition_index = 3 if parts[2] == 'IF' else 2
+        if len(parts) > condition_index:
+            # ZERO, CARRY and KEY name their own jump type; the key after KEY is
+            # not read, so key stays 0
+            condition = parts[condition_index]
+            if condition in JUMP_TYPES:
+                jump_type = condition
+    
+    # Determine target address - this is the instruction address where we want to jump
+    addr = None
+    is_function_call = False
+    
+    # Check if it's a line number (L1, L2, etc.)
+    if line_labels and label.startswith('L') and label[1:].isdigit():
+        line_num = int(label[1:])
+        if f'L{line_num}' in line_labels:
+            addr = line_labels[f'L{line_num}']
+        else:
+            raise ValueError(f"Unknown line label: '{label}'. Available line labels: {', '.join(sorted(line_labels.keys()))}")
+    # Check if it's a function call (with or without brackets)
+    elif functions and label in functions:
+        addr = functions[label]
+        is_function_call = True
+    elif functions and bracketed:
+        func_name = label[1:-1]
+        if func_name in functions:
+            addr = functions[func_name]
             is_function_call = True
-        elif functions and label.startswith('[') and label.endswith(']'):
-            func_name = label[1:-1].upper()
-            if func_name in functions:
-                addr = functions[func_name]
-                is_function_call = True
-            elif func_name in fake_functions:
-                # Fake function - we'll handle this as a function call too
-                addr = 0  # Placeholder, will be expanded inline
-                is_function_call = True
-        # Check if it's a fake function without brackets
-        elif fake_functions and label.upper() in fake_functions:
+        elif func_name in fake_functions:
+            # Fake function - we'll handle this as a function call too
             addr = 0  # Placeholder, will be expanded inline
             is_function_call = True
-        # Check if it's a regular label
-        elif label.upper() in labels:
-            addr = labels[label.upper()]
-        else:
-            # Try to parse it as a number (direct instruction address)
-            try:
-                addr = parse_number(label)
-            except ValueError:
-                raise ValueError(f"Unknown jump target: '{label}'. Make sure the label is defined with a colon (e.g., '{label}:') or use line syntax (e.g., 'L5').")
-        
-        # If it's a function call, we need to store the return address
-        if is_function_call:
-            # Find the function name
-            func_name = None
-            if label.startswith('[') and label.endswith(']'):
-                func_name = label[1:-1].upper()
-            else:
-                func_name = label.upper()
-            
-            # Return a special marker for function calls that the assembler will expand
-            return ('FUNCTION_CALL', func_name, 0, jump_type, key)
-        
-        # Handle special case for "ANY KEY"
-        if ((len(parts) > 4 and parts[3].upper() == 'ANY' and parts[4].upper() == 'KEY') or
-            (len(parts) > 3 and parts[2].upper() == 'ANY' and parts[3].upper() == 'KEY')):
-            jt = JUMP_TYPES['KEY']  # Use KEY jump type
-            key = KEYS['ANY']  # Use ANY key value (0xF)
-        else:
-            jt = JUMP_TYPES.get(jump_type, 0)
-        
-        # According to opcodes.txt:
-        # DATA3: usereg(1B)/key - usereg in upper nibble, key in lower nibble
-        # DATA2: reg(4B)/jmptype(4B) - reg in upper nibble, jump type in lower nibble
-        # DATA1: addrs - the instruction address to jump to (resolved from label)
-        if addr is None:
-            raise ValueError(f"Could not resolve instruction address for jump target: '{label}'")
-        
-        usereg = 0  # 0 = use address directly, 1 = use register
-        reg = 0     # register to use if usereg=1
-        
-        # Add 1 to the jump address to fix hardware issue
-        addr = (addr + 1) & 0xFF
-        
-        data3 = (usereg << 4) | (key & 0xF)
-        data2 = (reg << 4) | (jt & 0xF)
-        data1 = addr & 0xFF
-        
-        return (data3, data2, data1, OPCODES['JUMP'])
+    # Check if it's a fake function without brackets
+    elif fake_functions and label in fake_functions:
+        addr = 0  # Placeholder, will be expanded inline
+        is_function_call = True
+    # Check if it's a regular label
+    elif label in labels:
+        addr = labels[label]
+    else:
+        # Try to parse it as a number (direct instruction address)
+        try:
+            addr = parse_number(label)
+        except ValueError:
+            raise ValueError(f"Unknown jump target: '{label}'. Make sure the label is defined with a colon (e.g., '{label}:') or use line syntax (e.g., 'L5').")
+    
+    # If it's a function call, we need to store the return address
+    if is_function_call:
+        # Find the function name
+        func_name = label[1:-1] if bracketed else label
+        
+        # Return a special marker for function calls that the assembler will expand
+        return ('FUNCTION_CALL', func_name, 0, jump_type, key)
+    
+    # Handle special case for "ANY KEY" (function calls above ignore it)
+    if any_key:
+        jt = JUMP_TYPE_NIBBLES['KEY']  # Use KEY jump type
+        key = KEYS['ANY']  # Use ANY key value (0xF)
+    else:
+        jt = JUMP_TYPE_NIBBLES.get(jump_type, 0)
+    
+    # According to opcodes.txt:
+    # DATA3: usereg(1B)/key - usereg in upper nibble, key in lower nibble
+    # DATA2: reg(4B)/jmptype(4B) - reg in upper nibble, jump type in lower nibble
+    # DATA1: addrs - the instruction address to jump to (resolved from label)
+    if addr is None:
+        raise ValueError(f"Could not resolve instruction address for jump target: '{label}'")
+    
+    usereg = 0  # 0 = use address directly, 1 = use register
+    reg = 0     # register to use if usereg=1
+    
+    # Add 1 to the jump address to fix hardware issue
+    addr = (addr + 1) & 0xFF
+    
+    data3 = (usereg << 4) | (key & 0xF)
+    data2 = (reg << 4) | jt
+    data1 = addr & 0xFF
+    
+    return (data3, data2, data1, OP_JUMP)
 
-    # ALU binary op: A + B = C or C = A + B
-    # Format 1: val1 op val2 = outreg
-    match = re.match(r'([A-Z0-9\[\]]+)\s*([+*/]|NAND|AND|OR|NOR|XOR|XNOR|COMPARE|COMPARE_SIGNED|-)\s*([A-Z0-9\[\]]+)\s*=\s*([A-Z]+)', line)
-    if match:
-        val1_str, op, val2_str, outreg = match.groups()
-        
-        # Parse the values which could be registers, constants, or memory addresses
-        val1_type, val1 = parse_value(val1_str)
-        val2_type, val2 = parse_value(val2_str)
-        
-        # Check if both operands are RAM addresses - not allowed
-        if val1_type == VALUE_TYPES['RAM'] and val2_type == VALUE_TYPES['RAM']:
-            raise ValueError(f"Cannot use two RAM addresses in a single operation: {line}")
-        
-        opnum = ALU_OPS[op]
-        out = REGISTERS[outreg]
-        
-        # According to opcodes.txt:
-        # DATA3: reg1nibble/op - reg1 in upper nibble, op in lower nibble
-        # DATA2: reg2Type(2B)/reg1Type(2B)/outReg(4B)
-        # DATA1: reg2/1 - reg2 in upper nibble, reg1 in lower nibble
-        
-        # For ALU operations, reg1nibble refers to the first operand's register/value
-        # If val1 is a register, use its register code; otherwise use the value itself
-        reg1_nibble = val1 if val1_type == VALUE_TYPES['REGISTER'] else val1 & 0xF
-        
-        data3 = (reg1_nibble << 4) | (opnum & 0xF)
-        data2 = (val2_type << 6) | (val1_type << 4) | out
-        data1 = ((val2 & 0xF) << 4) | (val1 & 0xF)
-        
-        return (data3, data2, data1, OPCODES['ALU'])
+def parse_if(line, parts, labels, functions, line_labels, fake_functions):
+    # IF statement - this is a fake instruction that gets expanded
+    if not line.startswith('IF '):
+        raise ValueError(f"Unknown instruction: {line}")
+    return ('IF_STATEMENT', line, 0, 'SPECIAL')
 
+def pack_alu(op, val1_type, val1, val2_type, val2, out):
+    """Encode an ALU operation from its parsed operands"""
+    # According to opcodes.txt:
+    # DATA3: reg1nibble/op - reg1 in upper nibble, op in lower nibble
+    # DATA2: reg2Type(2B)/reg1Type(2B)/outReg(4B)
+    # DATA1: reg2/1 - reg2 in upper nibble, reg1 in lower nibble
+    
+    # For ALU operations, reg1nibble refers to the first operand's register/value
+    # If val1 is a register, use its register code; otherwise use the value itself
+    reg1_nibble = val1 if val1_type == VT_REGISTER else val1 & 0xF
+    
+    data3 = (reg1_nibble << 4) | ALU_OP_NIBBLES[op]
+    data2 = (val2_type << 6) | (val1_type << 4) | out
+    data1 = ((val2 & 0xF) << 4) | (val1 & 0xF)
+    
+    return (data3, data2, data1, OP_ALU)
+
+def split_binary_alu(parts):
+    """Read a spaced-out binary ALU line straight from its words.
+    
+    Returns (val1, op, val2, outreg), or None when the line needs the regex.
+    """
+    if len(parts) != 5:
+        return None
+    # Format 1: val1 op val2 = outreg
+    if parts[3] == '=' and parts[1] in BINARY_ALU_OPS and parts[4] in REGISTERS:
+        val1_str, op, val2_str, _, outreg = parts
     # Format 2: outreg = val1 op val2
-    match = re.match(r'([A-Z]+)\s*=\s*([A-Z0-9\[\]]+)\s*([+*/]|NAND|AND|OR|NOR|XOR|XNOR|COMPARE|COMPARE_SIGNED|-)\s*([A-Z0-9\[\]]+)', line)
-    if match:
-        outreg, val1_str, op, val2_str = match.groups()
+    elif parts[1] == '=' and parts[3] in BINARY_ALU_OPS and parts[0] in REGISTERS:
+        outreg, _, val1_str, op, val2_str = parts
+    else:
+        return None
+    # Operands with other characters are left to the regex to accept or reject
+    if val1_str.strip(OPERAND_CHARS) or val2_str.strip(OPERAND_CHARS):
+        return None
+    return val1_str, op, val2_str, outreg
+
+def parse_alu(line, parts, labels, functions, line_labels, fake_functions):
+    # Every ALU form assigns to a register, so a line without '=' is not one of them
+    # and doesn't need to go through the patterns below
+    if '=' not in line:
+        raise ValueError(f"Unknown instruction: {line}")
+    
+    # ALU binary op: A + B = C or C = A + B
+    # The common spaced-out spelling is split on words, which skips the operator alternation
+    operands = split_binary_alu(parts)
+    if operands is None:
+        match = ALU_BINARY_RE.match(line)
+        if match:
+            groups = match.groups()
+            if groups[0] is not None:
+                # Format 1: val1 op val2 = outreg
+                operands = groups[:4]
+            else:
+                # Format 2: outreg = val1 op val2
+                outreg, val1_str, op, val2_str = groups[4:]
+                operands = (val1_str, op, val2_str, outreg)
+    if operands:
+        val1_str, op, val2_str, outreg = operands
         
         # Parse the values which could be registers, constants, or memory addresses
         val1_type, val1 = parse_value(val1_str)
         val2_type, val2 = parse_value(val2_str)
         
         # Check if both operands are RAM addresses - not allowed
-        if val1_type == VALUE_TYPES['RAM'] and val2_type == VALUE_TYPES['RAM']:
+        if val1_type == VT_RAM and val2_type == VT_RAM:
             raise ValueError(f"Cannot use two RAM addresses in a single operation: {line}")
         
-        opnum = ALU_OPS[op]
-        out = REGISTERS[outreg]
-        
-        # For ALU operations, reg1nibble refers to the first operand's register/value
-        # If val1 is a register, use its register code; otherwise use the value itself
-        reg1_nibble = val1 if val1_type == VALUE_TYPES['REGISTER'] else val1 & 0xF
-        
-        data3 = (reg1_nibble << 4) | (opnum & 0xF)
-        data2 = (val2_type << 6) | (val1_type << 4) | out
-        data1 = ((val2 & 0xF) << 4) | (val1 & 0xF)
-        
-        return (data3, data2, data1, OPCODES['ALU'])
+        return pack_alu(op, val1_type, val1, val2_type, val2, REGISTERS[outreg])
 
     # ALU unary op: NOT A = B or B = NOT A
-    # Format 1: NOT val1 = outreg
-    match = re.match(r'(NOT)\s+([A-Z0-9\[\]]+)\s*=\s*([A-Z]+)', line)
+    match = ALU_NOT_RE.match(line)
     if match:
-        op, val1_str, outreg = match.groups()
+        groups = match.groups()
+        if groups[0] is not None:
+            # Format 1: NOT val1 = outreg
+            op, val1_str, outreg = groups[:3]
+        else:
+            # Format 2: outreg = NOT val1
+            outreg, op, val1_str = groups[3:]
         
         # Parse the value which could be a register, constant, or memory address
         val1_type, val1 = parse_value(val1_str)
         
-        opnum = ALU_OPS[op]
-        val2 = 0  # unused input for NOT operation
-        val2_type = VALUE_TYPES['REGISTER']  # Doesn't matter for NOT
-        out = REGISTERS[outreg]
-        
-        # For ALU operations, reg1nibble refers to the first operand's register/value
-        # If val1 is a register, use its register code; otherwise use the value itself
-        reg1_nibble = val1 if val1_type == VALUE_TYPES['REGISTER'] else val1 & 0xF
-        
-        data3 = (reg1_nibble << 4) | (opnum & 0xF)
-        data2 = (val2_type << 6) | (val1_type << 4) | out
-        data1 = ((val2 & 0xF) << 4) | (val1 & 0xF)
-        
-        return (data3, data2, data1, OPCODES['ALU'])
+        # The second input is unused for NOT; encode it as register 0
+        return pack_alu(op, val1_type, val1, VT_REGISTER, 0, REGISTERS[outreg])
+    
+    raise ValueError(f"Unknown instruction: {line}")
 
-    # Format 2: outreg = NOT val1
-    match = re.match(r'([A-Z]+)\s*=\s*(NOT)\s+([A-Z0-9\[\]]+)', line)
-    if match:
-        outreg, op, val1_str = match.groups()
-        
-        # Parse the value which could be a register, constant, or memory address
-        val1_type, val1 = parse_value(val1_str)
-        
-        opnum = ALU_OPS[op]
-        val2 = 0  # unused input for NOT operation
-        val2_type = VALUE_TYPES['REGISTER']  # Doesn't matter for NOT
-        out = REGISTERS[outreg]
-        
-        # For ALU operations, reg1nibble refers to the first operand's register/value
-        # If val1 is a register, use its register code; otherwise use the value itself
-        reg1_nibble = val1 if val1_type == VALUE_TYPES['REGISTER'] else val1 & 0xF
-        
-        data3 = (reg1_nibble << 4) | (opnum & 0xF)
-        data2 = (val2_type << 6) | (val1_type << 4) | out
-        data1 = ((val2 & 0xF) << 4) | (val1 & 0xF)
-        
-        return (data3, data2, data1, OPCODES['ALU'])
+# Instruction handlers keyed by the first word of the line. Anything that isn't
+# listed here (e.g. "C = A + B") is tried as an ALU operation.
+DISPATCH = {
+    'RANDOM': parse_random,
+    'PUSH': parse_push,
+    'POP': parse_pop,
+    'SET': parse_set,
+    'STORE': parse_store,
+    'LOAD': parse_load,
+    'DRAW': parse_draw,
+    'JUMP': parse_jump,
+    'NOT': parse_alu,
+    'IF': parse_if,
+}
 
-    # IF statement - this is a fake instruction that gets expanded
-    if line.startswith('IF '):
-        return ('IF_STATEMENT', line, 0, 'SPECIAL')
-    
+# Keywords that take no operands and must make up the whole line. Their result never
+# varies, so it is returned directly without going through a handler
+NO_OPERAND_INSTRUCTIONS = {
+    'HALT': (0, 0, 0, OP_HALT),
+    # RETURN - Pop return address from stack and jump to it
+    # Return a special marker that the assembler will handle
+    # This will be expanded to: POP FROM RETURN TO X, JUMP X
+    'RETURN': ('RETURN', 0, 0, 'SPECIAL'),
+    'NOP': (0, 0, 0, OP_NOP),
+    'CLEARSCREEN': (0, 0, 0, OP_CLEARSCREEN),
+    'REFRESHSCREEN': (0, 0, 0, OP_REFRESHSCREEN),
     # ELSE and END are also fake instructions
-    if line == 'ELSE':
-        return ('ELSE', 0, 0, 'SPECIAL')
-    
-    if line == 'END':
-        return ('END', 0, 0, 'SPECIAL')
+    'ELSE': ('ELSE', 0, 0, 'SPECIAL'),
+    'END': ('END', 0, 0, 'SPECIAL'),
+}
+
+def parse_instruction(line, labels, functions=None, line_labels=None, call_stack_ptr=None, fake_functions=None):
+    # Callers pass lines already cleaned and uppercased (see clean_lines), so the
+    # handlers work on the uppercase words directly
+    if not line or line.endswith(':'):
+        return None
     
-    raise ValueError(f"Unknown instruction: {line}")
+    # Only jumps read labels and functions, so any other line is parsed once per
+    # distinct text through the cache (which calls back here with labels=None)
+    if labels is not None and not line.startswith('JUMP'):
+        return parse_static_instruction(line)
+
+    # Look up the handler from the first word instead of testing every keyword in turn
+    parts = line.split()
+    keyword = parts[0]
+    fixed = NO_OPERAND_INSTRUCTIONS.get(keyword)
+    if fixed is not None:
+        if line != keyword:
+            raise ValueError(f"Unknown instruction: {line}")
+        return fixed
+    handler = DISPATCH.get(keyword, parse_alu)
+    return handler(line, parts, labels, functions, line_labels, fake_functions)
+
+@functools.lru_cache(maxsize=4096)
+def parse_static_instruction(line):
+    """Parse a line whose encoding doesn't depend on labels or functions (anything but a JUMP)"""
+    return parse_instruction(line, None)
+
+@functools.lru_cache(maxsize=256)
+def fake_function_template(fake_func_instructions):
+    """Pre-expand a fake function body into runs of finished instructions.
+    
+    Returns a tuple whose items are either a tuple of instructions, copied as is at every
+    call site, or a source line that has to be parsed at the call site. Jumps stay as
+    source lines since their targets depend on labels and functions there, and so does
+    any line that fails to parse, so its error is still raised in order.
+    """
+    template = []
+    run = []
+    for instruction in fake_func_instructions:
+        static = not instruction.startswith('JUMP')
+        if static:
+            try:
+                result = parse_static_instruction(instruction)
+            except Exception:
+                # Parsed again at the call site, which raises the same error
+                static = False
+        if static:
+            if result:
+                if result[0] == 'RETURN':
+                    run.extend(generate_return_instructions())
+                else:
+                    run.append(result)
+            continue
+        if run:
+            template.append(tuple(run))
+            run = []
+        template.append(instruction)
+    if run:
+        template.append(tuple(run))
+    return tuple(template)
 
 def expand_fake_function(fake_func_instructions, labels, functions, line_labels, call_stack_ptr, fake_functions, functions_with_return=None):
     """Expand fake function instructions inline"""
@@ -688,7 +898,13 @@ def expand_fake_function(fake_func_instructions, labels, functions, line_labels,
         functions_with_return = set()
     
     expanded = []
-    for instruction in fake_func_instructions:
+    for instruction in fake_function_template(fake_func_instructions):
+        if not isinstance(instruction, str):
+            # A run of instructions that encode the same at every call site
+            expanded.extend(instruction)
+            continue
+        
+        # Jump targets depend on labels and functions at this call site
         result = parse_instruction(instruction, labels, functions, line_labels, call_stack_ptr, fake_functions)
         if result:
             if result[0] == 'FUNCTION_CALL':
@@ -697,12 +913,12 @@ def expand_fake_function(fake_func_instructions, labels, functions, line_labels,
                 if func_name and func_name in fake_functions:
                     # For fake function calls within fake functions, treat as regular jumps
                     # The label should already be set up to point to the expanded location
-                    jt = JUMP_TYPES.get(jump_type, 0) if jump_type else 0
+                    jt = JUMP_TYPES[jump_type]
                     if func_name in labels:
-                        expanded.append((key or 0, jt, (labels[func_name] + 1) & 0xFF, OPCODES['JUMP']))
+                        expanded.append((key or 0, jt, (labels[func_name] + 1) & 0xFF, OP_JUMP))
                     else:
                         # If not found in labels, this might be a forward reference or error
-                        expanded.append((key or 0, jt, 1, OPCODES['JUMP']))
+                        expanded.append((key or 0, jt, 1, OP_JUMP))
                 else:
                     # Real function call - only use D register if function has RETURN
                     expanded.extend(generate_function_call_instructions(func_name, jump_type, key, functions_with_return))
@@ -713,6 +929,47 @@ def expand_fake_function(fake_func_instructions, labels, functions, line_labels,
                 expanded.append(result)
     return expanded
 
+def emit_function_call(result, instrs, pending_calls, instruction_address, labels, functions, line_labels, call_stack_ptr,
+                       fake_functions, functions_with_return, mark_fake_start=False):
+    """Append the code for a FUNCTION_CALL marker and return the next instruction address.
+    
+    The index of a jump whose target is still a function name is added to pending_calls.
+    """
+    _, func_name, _, jump_type, key = result
+    
+    if func_name and func_name in fake_functions:
+        # Expand fake function inline
+        if mark_fake_start:
+            # Mark the start position for potential recursive jumps
+            labels[func_name] = instruction_address
+        
+        expanded = expand_fake_function(fake_functions[func_name],
+                                        labels, functions, line_labels, call_stack_ptr, fake_functions, functions_with_return)
+        instrs.extend(expanded)
+        return instruction_address + len(expanded)
+    
+    # Regular function call - only use D register if function has RETURN
+    if func_name in functions_with_return:
+        # Function has RETURN - store location for return address calculation
+        # Store return address (will be resolved later)
+        instrs.append(('STORE_RETURN_ADDR', instruction_address, 0, 'SPECIAL'))
+        instruction_address += 2  # STORE_RETURN_ADDR generates 2 instructions
+    
+    # Jump to function (store function name; the address is filled in once functions are placed)
+    jt = JUMP_TYPES[jump_type]
+    pending_calls.append(len(instrs))
+    instrs.append((key, jt, func_name, OP_JUMP))
+    return instruction_address + 1
+
+def resolve_function_calls(instrs, pending_calls, functions):
+    """Fill in the addresses of the function call jumps listed in pending_calls"""
+    for i in pending_calls:
+        instr = instrs[i]
+        func_name = instr[2]
+        if func_name in functions and functions[func_name] is not None:
+            # Update the jump address to the resolved instruction address
+            instrs[i] = (instr[0], instr[1], (functions[func_name] + 1) & 0xFF, instr[3])
+
 def generate_function_call_instructions(target_addr, jump_type=None, key=0, functions_with_return=None):
     """Generate instructions for function call with return address storage"""
     if functions_with_return is None:
@@ -728,8 +985,8 @@ def generate_function_call_instructions(target_addr, jump_type=None, key=0, func
         instructions.append(('STORE_RETURN_ADDR', 0, 0, 'SPECIAL'))
     
     # Jump to function - add 1 to the target address
-    jt = JUMP_TYPES.get(jump_type, 0) if jump_type else 0
-    instructions.append((key, jt, (target_addr + 1) & 0xFF, OPCODES['JUMP']))
+    jt = JUMP_TYPES[jump_type]
+    instructions.append((key, jt, (target_addr + 1) & 0xFF, OP_JUMP))
     
     return instructions
 
@@ -746,16 +1003,11 @@ def parse_if_condition(condition_str):
     """Parse an if condition and return the comparison operation and operands"""
     condition_str = condition_str.strip()
     
-    # Support different comparison operators
-    comparison_ops = ['==', '!=', '<=', '>=', '<', '>']
-    
-    for op in comparison_ops:
-        if op in condition_str:
-            parts = condition_str.split(op, 1)
-            if len(parts) == 2:
-                left = parts[0].strip()
-                right = parts[1].strip()
-                return left, op, right
+    # Two-character operators are tried first so '<=' isn't read as '<'
+    for op in COMPARISON_OPS:
+        left, found, right = condition_str.partition(op)
+        if found:
+            return left.strip(), op, right.strip()
     
     raise ValueError(f"Invalid if condition: {condition_str}")
 
@@ -782,12 +1034,11 @@ def generate_if_instructions(if_line, then_instructions, else_instructions, labe
     right_type, right = parse_value(right_val)
     
     # Check if both operands are RAM addresses - not allowed
-    if left_type == VALUE_TYPES['RAM'] and right_type == VALUE_TYPES['RAM']:
+    if left_type == VT_RAM and right_type == VT_RAM:
         raise ValueError(f"Cannot compare two RAM addresses: {condition_part}")
     
     # Generate unique labels for this if statement
-    import time
-    unique_id = int(time.time() * 1000000) % 1000000  # Use microseconds for uniqueness
+    unique_id = next(IF_LABEL_IDS)
     else_label = f"_IF_ELSE_{unique_id}"
     end_label = f"_IF_END_{unique_id}"
     then_label = f"_IF_THEN_{unique_id}"
@@ -797,217 +1048,187 @@ def generate_if_instructions(if_line, then_instructions, else_instructions, labe
     compare_op = 'COMPARE'  # Use unsigned compare by default
     
     # For ALU operations, reg1nibble refers to the first operand's register/value
-    reg1_nibble = left if left_type == VALUE_TYPES['REGISTER'] else left & 0xF
+    reg1_nibble = left if left_type == VT_REGISTER else left & 0xF
     
     # Generate comparison instruction (left COMPARE right = X register for result)
     # We'll use register X (0b100) to store the comparison result
     result_reg = REGISTERS['X']
-    opnum = ALU_OPS[compare_op]
     
-    data3 = (reg1_nibble << 4) | (opnum & 0xF)
+    data3 = (reg1_nibble << 4) | ALU_OP_NIBBLES[compare_op]
     data2 = (right_type << 6) | (left_type << 4) | result_reg
     data1 = (right << 4) | left
     
-    instructions.append((data3, data2, data1, OPCODES['ALU']))
+    instructions.append((data3, data2, data1, OP_ALU))
     
     # Calculate addresses for labels (we need to do this before creating jump instructions)
-    instruction_count = 1  # We already have the compare instruction
-    
-    # Now generate the conditional jump based on the comparison operator
-    # COMPARE sets flags: zero flag if equal, carry flag if left < right
-    
-    if op == '==':
-        # Jump to then block if zero (equal), otherwise fall through to else
-        instruction_count += 1  # Jump to then
-        instruction_count += 1  # Jump to else (unconditional)
-        
-        then_addr = instruction_address + instruction_count
-        labels[then_label] = then_addr
-        
-        instruction_count += len(then_instructions)
-        if else_instructions:
-            instruction_count += 1  # Jump over else block
-        
-        else_addr = instruction_address + instruction_count
-        labels[else_label] = else_addr
-        
-        instruction_count += len(else_instructions)
-        end_addr = instruction_address + instruction_count
-        labels[end_label] = end_addr
-        
-        # Generate the actual jump instructions
-        instructions.append((0, JUMP_TYPES['ZERO'], (then_addr + 1) & 0xFF, OPCODES['JUMP']))
-        instructions.append((0, JUMP_TYPES[None], (else_addr + 1) & 0xFF, OPCODES['JUMP']))
-        
-        # Then block
-        instructions.extend(then_instructions)
-        
-        # Jump over else block
-        if else_instructions:
-            instructions.append((0, JUMP_TYPES[None], (end_addr + 1) & 0xFF, OPCODES['JUMP']))
-    
-    elif op == '!=':
-        # Jump to else if zero (equal), fall through to then if not equal
-        instruction_count += 1  # Jump to else
-        
-        then_addr = instruction_address + instruction_count
-        labels[then_label] = then_addr
-        
-        instruction_count += len(then_instructions)
+    # The comparison operator decides which jumps follow the compare
+    jumps = IF_JUMPS[op]
+    
+    # When the jumps end in an unconditional jump to the else block, the else block can
+    # take that jump's place and jump over the then block instead, saving an instruction
+    else_first = bool(else_instructions) and jumps[-1][0] == JT_ALWAYS
+    if else_first:
+        jumps = jumps[:-1]
+        else_addr = instruction_address + 1 + len(jumps)  # After the compare and the jumps
+        then_addr = else_addr + len(else_instructions) + 1  # After the jump over the then block
+        end_addr = then_addr + len(then_instructions)
+    else:
+        then_addr = instruction_address + 1 + len(jumps)  # After the compare and the jumps
+        else_addr = then_addr + len(then_instructions)
         if else_instructions:
-            instruction_count += 1  # Jump over else block
-        
-        else_addr = instruction_address + instruction_count
-        labels[else_label] = else_addr
-        
-        instruction_count += len(else_instructions)
-        end_addr = instruction_address + instruction_count
-        labels[end_label] = end_addr
-        
-        # Generate the actual jump instructions
-        instructions.append((0, JUMP_TYPES['ZERO'], (else_addr + 1) & 0xFF, OPCODES['JUMP']))
-        
-        # Then block (fall through)
+            else_addr += 1  # Jump over else block
+        end_addr = else_addr + len(else_instructions)
+    labels[then_label] = then_addr
+    labels[else_label] = else_addr
+    labels[end_label] = end_addr
+    
+    # Generate the actual jump instructions
+    for jump_type, target in jumps:
+        target_addr = then_addr if target == 'THEN' else else_addr
+        instructions.append((0, jump_type, (target_addr + 1) & 0xFF, OP_JUMP))
+    
+    if else_first:
+        # Else block, then a jump over the then block
+        instructions.extend(else_instructions)
+        instructions.append((0, JT_ALWAYS, (end_addr + 1) & 0xFF, OP_JUMP))
         instructions.extend(then_instructions)
-        
-        # Jump over else block
-        if else_instructions:
-            instructions.append((0, JUMP_TYPES[None], (end_addr + 1) & 0xFF, OPCODES['JUMP']))
-    
-    elif op == '<':
-        # Jump to then if carry (left < right), otherwise fall through to else
-        instruction_count += 1  # Jump to then
-        instruction_count += 1  # Jump to else (unconditional)
-        
-        then_addr = instruction_address + instruction_count
-        labels[then_label] = then_addr
-        
-        instruction_count += len(then_instructions)
-        if else_instructions:
-            instruction_count += 1  # Jump over else block
-        
-        else_addr = instruction_address + instruction_count
-        labels[else_label] = else_addr
-        
-        instruction_count += len(else_instructions)
-        end_addr = instruction_address + instruction_count
-        labels[end_label] = end_addr
-        
-        # Generate the actual jump instructions
-        instructions.append((0, JUMP_TYPES['CARRY'], (then_addr + 1) & 0xFF, OPCODES['JUMP']))
-        instructions.append((0, JUMP_TYPES[None], (else_addr + 1) & 0xFF, OPCODES['JUMP']))
-        
+    else:
         # Then block
         instructions.extend(then_instructions)
         
-        # Jump over else block
+        # Jump over the else block, then the else block itself (if it exists)
         if else_instructions:
-            instructions.append((0, JUMP_TYPES[None], (end_addr + 1) & 0xFF, OPCODES['JUMP']))
+            instructions.append((0, JT_ALWAYS, (end_addr + 1) & 0xFF, OP_JUMP))
+            instructions.extend(else_instructions)
     
-    elif op == '>=':
-        # Jump to else if carry (left < right), fall through to then if not
-        instruction_count += 1  # Jump to else
-        
-        then_addr = instruction_address + instruction_count
-        labels[then_label] = then_addr
-        
-        instruction_count += len(then_instructions)
-        if else_instructions:
-            instruction_count += 1  # Jump over else block
-        
-        else_addr = instruction_address + instruction_count
-        labels[else_label] = else_addr
-        
-        instruction_count += len(else_instructions)
-        end_addr = instruction_address + instruction_count
-        labels[end_label] = end_addr
-        
-        # Generate the actual jump instructions
-        instructions.append((0, JUMP_TYPES['CARRY'], (else_addr + 1) & 0xFF, OPCODES['JUMP']))
-        
-        # Then block (fall through)
-        instructions.extend(then_instructions)
-        
-        # Jump over else block
-        if else_instructions:
-            instructions.append((0, JUMP_TYPES[None], (end_addr + 1) & 0xFF, OPCODES['JUMP']))
-    
-    elif op == '>':
-        # left > right means NOT(left <= right) means NOT(left < right OR left == right)
-        # Jump to else if zero (equal) or carry (less than)
-        instruction_count += 1  # Jump to else on zero
-        instruction_count += 1  # Jump to else on carry
-        
-        then_addr = instruction_address + instruction_count
-        labels[then_label] = then_addr
-        
-        instruction_count += len(then_instructions)
-        if else_instructions:
-            instruction_count += 1  # Jump over else block
-        
-        else_addr = instruction_address + instruction_count
-        labels[else_label] = else_addr
-        
-        instruction_count += len(else_instructions)
-        end_addr = instruction_address + instruction_count
-        labels[end_label] = end_addr
-        
-        # Generate the actual jump instructions
-        instructions.append((0, JUMP_TYPES['ZERO'], (else_addr + 1) & 0xFF, OPCODES['JUMP']))
-        instructions.append((0, JUMP_TYPES['CARRY'], (else_addr + 1) & 0xFF, OPCODES['JUMP']))
-        
-        # Then block (fall through)
-        instructions.extend(then_instructions)
-        
-        # Jump over else block
-        if else_instructions:
-            instructions.append((0, JUMP_TYPES[None], (end_addr + 1) & 0xFF, OPCODES['JUMP']))
-    
-    elif op == '<=':
-        # left <= right means left < right OR left == right
-        # Jump to then if zero (equal) or carry (less than)
-        instruction_count += 1  # Jump to then on zero
-        instruction_count += 1  # Jump to then on carry
-        instruction_count += 1  # Jump to else (unconditional)
-        
-        then_addr = instruction_address + instruction_count
-        labels[then_label] = then_addr
-        
-        instruction_count += len(then_instructions)
-        if else_instructions:
-            instruction_count += 1  # Jump over else block
-        
-        else_addr = instruction_address + instruction_count
-        labels[else_label] = else_addr
-        
-        instruction_count += len(else_instructions)
-        end_addr = instruction_address + instruction_count
-        labels[end_label] = end_addr
-        
-        # Generate the actual jump instructions
-        instructions.append((0, JUMP_TYPES['ZERO'], (then_addr + 1) & 0xFF, OPCODES['JUMP']))
-        instructions.append((0, JUMP_TYPES['CARRY'], (then_addr + 1) & 0xFF, OPCODES['JUMP']))
-        instructions.append((0, JUMP_TYPES[None], (else_addr + 1) & 0xFF, OPCODES['JUMP']))
-        
-        # Then block
-        instructions.extend(then_instructions)
-        
-        # Jump over else block
-        if else_instructions:
-            instructions.append((0, JUMP_TYPES[None], (end_addr + 1) & 0xFF, OPCODES['JUMP']))
+    return instructions
+
+# Listing text of instructions without operands
+FIXED_LISTINGS = {
+    OP_NOP: "NOP",
+    OP_HALT: "HALT",
+    OP_CLEARSCREEN: "CLEARSCREEN",
+    OP_REFRESHSCREEN: "REFRESHSCREEN",
+}
+
+def format_operand(value, value_type):
+    """Format an ALU operand for the listing according to its value type"""
+    if value_type == VT_REGISTER:
+        return REGISTER_LISTING[value]
+    elif value_type == VT_BUILTIN:
+        return str(value)
+    elif value_type == VT_RAM:
+        return f"[{value}]"
+    return f"?{value}"
+
+def disassemble_alu(data3, data2, data1):
+    # Extract components from data fields
+    op_code = data3 & 0xF
+    reg2_type = (data2 >> 6) & 0x3
+    reg1_type = (data2 >> 4) & 0x3
+    out_reg = data2 & 0xF
+    reg2 = (data1 >> 4) & 0xF
+    reg1 = data1 & 0xF
+    
+    # Get register and operation names
+    out_reg_name = REGISTER_LISTING[out_reg]
+    op_name = ALU_OP_LISTING[op_code]
+    
+    # Format operands based on type
+    reg1_str = format_operand(reg1, reg1_type)
+    reg2_str = format_operand(reg2, reg2_type)
+    
+    return f"{out_reg_name} = {reg1_str} {op_name} {reg2_str}"
+
+def disassemble_store(data3, data2, data1):
+    reg_name = REGISTER_LISTING[data2]
+    return f"STORE {reg_name} into [{data1}]"
+
+def disassemble_load(data3, data2, data1):
+    reg_name = REGISTER_LISTING[data2]
+    return f"LOAD [{data1}] into {reg_name}"
+
+def disassemble_set(data3, data2, data1):
+    reg_name = REGISTER_LISTING[data2]
+    return f"SET {reg_name} to {data1}"
+
+def disassemble_jump(data3, data2, data1):
+    usereg = (data3 >> 4) & 0x1
+    key = data3 & 0xF
+    reg = (data2 >> 4) & 0xF
+    jmptype = data2 & 0xF
+    addr = data1
+    
+    # Get jump type name
+    jmp_type_name = JUMP_TYPE_LISTING[jmptype]
+    
+    if usereg:
+        reg_name = REGISTER_LISTING[reg]
+        instruction = f"JUMP {reg_name}"
+    else:
+        instruction = f"JUMP {addr}"
     
-    # Else block (if it exists)
-    if else_instructions:
-        instructions.extend(else_instructions)
+    if jmp_type_name:
+        instruction += f" if {jmp_type_name}"
     
-    return instructions
+    if jmptype == JT_KEY:
+        key_name = KEY_LISTING[key]
+        instruction += f" {key_name}"
+    return instruction
+
+def disassemble_draw(data3, data2, data1):
+    b = data3 & 0xF
+    r = (data2 >> 4) & 0xF
+    g = data2 & 0xF
+    y = (data1 >> 4) & 0xF
+    x = data1 & 0xF
+    return f"DRAW {x} {y} {r} {g} {b}"
+
+def disassemble_random(data3, data2, data1):
+    reg_name = REGISTER_LISTING[data2]
+    return f"RANDOM {reg_name}"
+
+def disassemble_stack(data3, data2, data1):
+    stack_op = (data3 >> 2) & 0x3
+    stack_type = data3 & 0x3
+    reg = data2 & 0xF
+    value = data1
+    
+    # Get stack operation and type names
+    op_name = STACK_OP_LISTING[stack_op]
+    stack_name = STACK_TYPE_LISTING[stack_type]
+    
+    if reg == 0xF:  # No register, use value
+        return f"{op_name} {stack_name} {value}"
+    reg_name = REGISTER_LISTING[reg]
+    return f"{op_name} {stack_name} {reg_name}"
+
+# Listing handler for each opcode with operands, looked up instead of testing each opcode in turn
+DISASSEMBLERS = {
+    OP_ALU: disassemble_alu,
+    OP_STORE: disassemble_store,
+    OP_LOAD: disassemble_load,
+    OP_SET: disassemble_set,
+    OP_JUMP: disassemble_jump,
+    OP_DRAW: disassemble_draw,
+    OP_RANDOM: disassemble_random,
+    OP_STACK: disassemble_stack,
+}
 
 def assemble(filepath):
     with open(filepath, 'r') as f:
         lines = f.readlines()
 
+    # Strip comments and whitespace once; every pass below works on these lines
+    cleaned = clean_lines(lines)
+    # Likewise fold each line's case and split each label line at its colon once
+    upper_lines = [clean_line.upper() for clean_line in cleaned]
+    label_defs = split_labels(cleaned)
+    # And match up IF/ELSE/END once instead of scanning ahead from every IF
+    if_blocks = match_if_blocks(upper_lines)
+
     # First pass to identify functions and fake functions only
-    functions, fake_functions, functions_with_return = first_pass(lines)
+    functions, fake_functions, functions_with_return = first_pass(upper_lines, label_defs)
     
     # Initialize instruction address tracking
     labels = {}
@@ -1017,211 +1238,129 @@ def assemble(filepath):
     # Initialize call stack pointer
     call_stack_ptr = {'current': STACK_START}
     
-    # Separate main program from functions
-    main_lines = []
-    function_lines = {}
-    current_function = None
-    
-    for i, line in enumerate(lines):
-        clean_line = re.sub(r'//.*', '', line).strip()
-        if not clean_line:
-            continue
-            
-        # Check if this is a function definition
-        if ':' in clean_line:
-            label_part = clean_line.split(':')[0].strip()
-            if label_part.startswith('[') and label_part.endswith(']'):
-                func_name = label_part[1:-1].upper()
-                if func_name not in fake_functions:  # Real function
-                    current_function = func_name
-                    function_lines[func_name] = []
-                else:
-                    # Fake function - don't process it
-                    current_function = None
-                continue
-            else:
-                # Check if it's a fake function without brackets
-                rest_of_line = clean_line.split(':', 1)[1].strip().upper()
-                if rest_of_line == 'FAKE':
-                    # Fake function - don't process it
-                    current_function = None
-                    continue
-                else:
-                    # Check if this is a function (already detected in first pass)
-                    func_name = label_part.upper()
-                    if func_name in functions:
-                        current_function = func_name
-                        function_lines[func_name] = []
-                        continue
-                    else:
-                        # Regular label
-                        current_function = None
-        
-        # Add line to appropriate section
-        if current_function:
-            function_lines[current_function].append(line)
-        else:
-            main_lines.append(line)
-    
     # Process main program with proper instruction address tracking
     main_instrs = []
+    main_calls = []  # Indices of function call jumps in main_instrs awaiting their address
     # Start with 2 NOPs as per original code
-    main_instrs.append((0, 0, 0, OPCODES['NOP']))
-    main_instrs.append((0, 0, 0, OPCODES['NOP']))
+    main_instrs.append(NOP_INSTR)
+    main_instrs.append(NOP_INSTR)
     instruction_address = 2  # Account for the 2 initial NOPs
 
-    # First pass: Create line labels for ALL source lines and collect labels with their instruction addresses
+    # First pass: Create line labels for ALL source lines and collect labels with their instruction addresses.
+    # The same walk also separates the lines of each real function from the main program
     temp_address = instruction_address
-    in_main_program = True
-    current_function_start = None
+    fake_sizes = {}  # Expanded size of each fake function, counted on first call
+    line_increments = {}  # Instruction count of each distinct line text
+    function_lines = {}
+    current_function = None
     
     # Create line labels for ALL source lines (L1, L2, etc.) - this must cover the entire file
-    for i, line in enumerate(lines):
-        clean_line = re.sub(r'//.*', '', line).strip()
-        
+    for i, clean_line in enumerate(cleaned):
         # Assign line label to current instruction address (for lines that will generate instructions)
         if clean_line and not clean_line.endswith(': fake'):
             # For lines that generate instructions, assign the line label to the current address
-            if not ':' in clean_line or (':' in clean_line and clean_line.split(':', 1)[1].strip()):
+            if not label_defs[i] or label_defs[i][1]:
                 # This line will generate an instruction, so assign the line label
                 line_labels[f'L{i+1}'] = temp_address
         else:
             # For empty lines or comments, assign the line label to current address (no instruction will be generated)
             line_labels[f'L{i+1}'] = temp_address
         
+        if not clean_line:
+            continue
+        
+        # Check if this is a function definition; otherwise add the line to the current function
+        if label_defs[i]:
+            label_part, rest_of_line = label_defs[i]
+            if label_part.startswith('[') and label_part.endswith(']'):
+                func_name = label_part[1:-1]
+                if func_name not in fake_functions:  # Real function
+                    current_function = func_name
+                    function_lines[func_name] = []
+                else:
+                    # Fake function - don't process it
+                    current_function = None
+            elif rest_of_line == 'FAKE':
+                # Fake function without brackets - don't process it
+                current_function = None
+            elif label_part in functions:
+                # Function detected in first pass
+                current_function = label_part
+                function_lines[current_function] = []
+            else:
+                # Regular label - the lines after it belong to the main program
+                current_function = None
+        elif current_function:
+            function_lines[current_function].append(upper_lines[i])
+        
         # Only increment address for lines that generate actual instructions
-        if clean_line and not clean_line.endswith(': fake'):
-            # Check if this is a label definition
-            if ':' in clean_line:
-                label_part = clean_line.split(':')[0].strip()
-                rest_of_line = clean_line.split(':', 1)[1].strip().upper() if len(clean_line.split(':', 1)) > 1 else ''
-                
+        if not clean_line.endswith(': fake'):
+            # Check if this is a label definition (label_part and rest_of_line were unpacked above)
+            if label_defs[i]:
                 # Skip fake functions
                 if rest_of_line == 'FAKE':
                     continue
-                    
-                # Check if this is a function definition
-                is_function_def = ((label_part.startswith('[') and label_part.endswith(']') and label_part[1:-1].upper() in functions) or
-                                 label_part.upper() in functions)
                 
-                if is_function_def:
-                    in_main_program = False
-                    current_function_start = temp_address
-                
-                # Labels should point to the next instruction that will be executed
-                # We need to find where the next actual instruction will be placed
-                next_instruction_addr = temp_address
-                
-                # Look ahead to find the next line that generates an instruction
-                for j in range(i + 1, len(lines)):
-                    next_line = re.sub(r'//.*', '', lines[j]).strip()
-                    if next_line and not next_line.endswith(': fake'):
-                        # Check if this is another label definition
-                        if ':' in next_line:
-                            next_label_part = next_line.split(':')[0].strip()
-                            next_rest_of_line = next_line.split(':', 1)[1].strip().upper() if len(next_line.split(':', 1)) > 1 else ''
-                            if next_rest_of_line == 'FAKE':
-                                continue
-                            # If it's another label, continue looking (labels don't increment address)
-                            continue
-                        else:
-                            # Found the next actual instruction
-                            break
-                
-                # Record all labels and their instruction addresses
+                # Labels point to the next instruction that will be executed. Labels, empty lines
+                # and fake functions don't advance temp_address, so that is simply temp_address
                 if label_part.startswith('[') and label_part.endswith(']'):
-                    labels[label_part[1:-1].upper()] = next_instruction_addr
+                    labels[label_part[1:-1]] = temp_address
                 else:
-                    labels[label_part.upper()] = next_instruction_addr
+                    labels[label_part] = temp_address
                 
                 # Don't increment temp_address for label definitions - the next instruction will use this address
                 continue
             
-            # Count actual instruction increments
-            instruction_increment = count_instruction_increment(clean_line, fake_functions, functions_with_return)
+            # Count actual instruction increments; identical lines (repeated calls and
+            # jumps in particular) always count the same, so each text is counted once
+            instruction_increment = line_increments.get(upper_lines[i])
+            if instruction_increment is None:
+                instruction_increment = count_instruction_increment(upper_lines[i], fake_functions, functions_with_return, fake_sizes)
+                line_increments[upper_lines[i]] = instruction_increment
             temp_address += instruction_increment
     
     # Second pass: Generate instructions for main program
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        clean_line = re.sub(r'//.*', '', line).strip()
-        
+    main_lines = enumerate(cleaned)
+    for i, clean_line in main_lines:
         if not clean_line:
-            i += 1
             continue
         
         # Check if we've hit a function definition - if so, stop processing main program
-        if ':' in clean_line:
-            label_part = clean_line.split(':')[0].strip()
-            rest_of_line = clean_line.split(':', 1)[1].strip().upper() if len(clean_line.split(':', 1)) > 1 else ''
+        if label_defs[i]:
+            label_part, rest_of_line = label_defs[i]
             
             # Skip fake functions
             if rest_of_line == 'FAKE':
-                i += 1
                 continue
                 
             # Skip function definitions (they're handled separately)
-            if ((label_part.startswith('[') and label_part.endswith(']') and label_part[1:-1].upper() in functions) or
-                label_part.upper() in functions):
+            if ((label_part.startswith('[') and label_part.endswith(']') and label_part[1:-1] in functions) or
+                label_part in functions):
                 # We've hit a real function, stop processing main program
                 break
             
             # Regular label - skip, already processed in first pass
-            i += 1
             continue
         
         # Check for IF statement
-        if clean_line.upper().startswith('IF '):
+        if upper_lines[i].startswith('IF '):
             # Collect the entire if block
             if_line = clean_line
-            then_instructions = []
-            else_instructions = []
-            
-            # Find the matching ELSE and END
-            j = i + 1
-            in_else = False
-            nesting_level = 0
             
-            while j < len(lines):
-                block_line = re.sub(r'//.*', '', lines[j]).strip()
-                if not block_line:
-                    j += 1
-                    continue
-                
-                block_line_upper = block_line.upper()
-                
-                # Track nesting level for nested if statements
-                if block_line_upper.startswith('IF '):
-                    nesting_level += 1
-                elif block_line_upper == 'END':
-                    if nesting_level == 0:
-                        # This is our matching END
-                        break
-                    else:
-                        nesting_level -= 1
-                elif block_line_upper == 'ELSE' and nesting_level == 0:
-                    # This is our matching ELSE
-                    in_else = True
-                    j += 1
-                    continue
-                
-                # Add instruction to appropriate block
-                if in_else:
-                    else_instructions.append(block_line)
-                else:
-                    then_instructions.append(block_line)
-                
-                j += 1
-            
-            if j >= len(lines):
+            # Find the matching ELSE and END from the prebuilt table
+            if i not in if_blocks:
                 raise ValueError(f"IF statement starting at line {i+1} has no matching END")
+            else_indices, j = if_blocks[i]
             
-            # Parse the then and else instructions
+            # Lines up to the first ELSE form the then block; any further top-level ELSE is skipped.
+            # Each line is parsed straight from the source as the block is read
+            split = else_indices[0] if else_indices else j
             parsed_then = []
-            for instr in then_instructions:
+            for k in range(i + 1, split):
+                if not upper_lines[k]:
+                    continue
                 try:
-                    result = parse_instruction(instr, labels, functions, line_labels, call_stack_ptr, fake_functions)
+                    result = parse_instruction(upper_lines[k], labels, functions, line_labels, call_stack_ptr, fake_functions)
                     if result:
                         parsed_then.append(result)
                 except ValueError as e:
@@ -1229,9 +1368,11 @@ def assemble(filepath):
                     sys.exit(1)
             
             parsed_else = []
-            for instr in else_instructions:
+            for k in range(split + 1, j):
+                if not upper_lines[k] or k in else_indices:
+                    continue
                 try:
-                    result = parse_instruction(instr, labels, functions, line_labels, call_stack_ptr, fake_functions)
+                    result = parse_instruction(upper_lines[k], labels, functions, line_labels, call_stack_ptr, fake_functions)
                     if result:
                         parsed_else.append(result)
                 except ValueError as e:
@@ -1247,40 +1388,18 @@ def assemble(filepath):
                 print(f"Error generating IF statement: {e}")
                 sys.exit(1)
             
-            # Skip to after the END
-            i = j + 1
+            # Skip to after the END by consuming the block's lines (i+1 through j)
+            next(itertools.islice(main_lines, j - i - 1, None), None)
             continue
         
         try:
-            result = parse_instruction(line, labels, functions, line_labels, call_stack_ptr, fake_functions)
+            result = parse_instruction(upper_lines[i], labels, functions, line_labels, call_stack_ptr, fake_functions)
             if result:
                 if result[0] == 'FUNCTION_CALL':
                     # Handle function call
-                    _, func_name, _, jump_type, key = result
-                    
-                    if func_name and func_name in fake_functions:
-                        # Expand fake function inline
-                        # Mark the start position for potential recursive jumps
-                        labels[func_name] = instruction_address
-                        
-                        expanded = expand_fake_function(fake_functions[func_name]['instructions'], 
-                                                     labels, functions, line_labels, call_stack_ptr, fake_functions, functions_with_return)
-                        main_instrs.extend(expanded)
-                        instruction_address += len(expanded)
-                    else:
-                        # Regular function call - only use D register if function has RETURN
-                        if func_name in functions_with_return:
-                            # Function has RETURN - store location for return address calculation
-                            call_location = instruction_address
-                            
-                            # Store return address (will be resolved later)
-                            main_instrs.append(('STORE_RETURN_ADDR', call_location, 0, 'SPECIAL'))
-                            instruction_address += 2  # STORE_RETURN_ADDR generates 2 instructions
-                        
-                        # Jump to function (store function name for later resolution)
-                        jt = JUMP_TYPES.get(jump_type, 0) if jump_type else 0
-                        main_instrs.append((key, jt, func_name, OPCODES['JUMP']))  # Store function name
-                        instruction_address += 1
+                    instruction_address = emit_function_call(result, main_instrs, main_calls, instruction_address, labels, functions,
+                                                             line_labels, call_stack_ptr, fake_functions, functions_with_return,
+                                                             mark_fake_start=True)
                 elif result[0] in ['IF_STATEMENT', 'ELSE', 'END']:
                     # These should have been handled above, skip them
                     pass
@@ -1294,12 +1413,10 @@ def assemble(filepath):
         except ValueError as e:
             print(f"Error: {e}")
             sys.exit(1)
-        
-        i += 1
 
     # Ensure program ends with HALT
-    if not main_instrs or main_instrs[-1][3] != OPCODES['HALT']:
-        main_instrs.append((0, 0, 0, OPCODES['HALT']))
+    if not main_instrs or main_instrs[-1][3] != OP_HALT:
+        main_instrs.append((0, 0, 0, OP_HALT))
         instruction_address += 1
     
     # The labels and functions should already be set from the first pass above
@@ -1309,15 +1426,11 @@ def assemble(filepath):
             functions[func_name] = labels[func_name]
     
     # Now resolve function call addresses in main program
-    for i, instr in enumerate(main_instrs):
-        if len(instr) == 4 and instr[3] == OPCODES['JUMP'] and isinstance(instr[2], str):  # Function call jump with function name
-            func_name = instr[2]
-            if func_name in functions and functions[func_name] is not None:
-                # Update the jump address to the resolved instruction address
-                main_instrs[i] = (instr[0], instr[1], (functions[func_name] + 1) & 0xFF, instr[3])
+    resolve_function_calls(main_instrs, main_calls, functions)
     
     # Add functions after main program
     function_instrs = []
+    function_calls = []  # Indices of function call jumps in function_instrs awaiting their address
     function_instruction_address = len(main_instrs)  # Functions start after main program
     
     for func_name, func_lines in function_lines.items():
@@ -1331,32 +1444,13 @@ def assemble(filepath):
                             function_instrs.append(('RETURN', 0, 0, 'SPECIAL'))
                             function_instruction_address += 2  # RETURN generates 2 instructions
                         elif result[0] == 'FUNCTION_CALL':
-                            # Handle function call within function
-                            _, func_name, _, jump_type, key = result
-                            
-                            if func_name and func_name in fake_functions:
-                                # Expand fake function inline
-                                expanded = expand_fake_function(fake_functions[func_name]['instructions'], 
-                                                             labels, functions, line_labels, call_stack_ptr, fake_functions, functions_with_return)
-                                function_instrs.extend(expanded)
-                                function_instruction_address += len(expanded)
-                            else:
-                                # Regular function call - only use D register if function has RETURN
-                                if func_name in functions_with_return:
-                                    # Function has RETURN - store location for return address calculation
-                                    call_location = function_instruction_address
-                                    
-                                    # Store return address (will be resolved later)
-                                    function_instrs.append(('STORE_RETURN_ADDR', call_location, 0, 'SPECIAL'))
-                                    function_instruction_address += 2  # STORE_RETURN_ADDR generates 2 instructions
-                                
-                                # Jump to function
-                                jt = JUMP_TYPES.get(jump_type, 0) if jump_type else 0
-                                if func_name in functions and functions[func_name] is not None:
-                                    function_instrs.append((key, jt, (functions[func_name] + 1) & 0xFF, OPCODES['JUMP']))
-                                else:
-                                    function_instrs.append((key, jt, func_name, OPCODES['JUMP']))  # Store function name for later resolution
-                                function_instruction_address += 1
+                            # Handle function call within function. Error messages for the rest of
+                            # this function name the callee, as they always have
+                            func_name = result[1]
+                            function_instruction_address = emit_function_call(result, function_instrs, function_calls,
+                                                                              function_instruction_address,
+                                                                              labels, functions, line_labels, call_stack_ptr,
+                                                                              fake_functions, functions_with_return)
                         else:
                             function_instrs.append(result)
                             function_instruction_address += 1
@@ -1365,19 +1459,15 @@ def assemble(filepath):
                     sys.exit(1)
     
     # Resolve function call addresses in function instructions
-    for i, instr in enumerate(function_instrs):
-        if len(instr) == 4 and instr[3] == OPCODES['JUMP'] and isinstance(instr[2], str):  # Function call jump with function name
-            func_name = instr[2]
-            if func_name in functions and functions[func_name] is not None:
-                # Update the jump address to the resolved instruction address
-                function_instrs[i] = (instr[0], instr[1], (functions[func_name] + 1) & 0xFF, instr[3])
+    resolve_function_calls(function_instrs, function_calls, functions)
     
     # Combine main program and functions
     all_instrs = main_instrs + function_instrs
     
     # Resolve STORE_RETURN_ADDR and RETURN instructions
     resolved_instrs = []
-    for i, instr in enumerate(all_instrs):
+    reg_d = REGISTERS['D']
+    for instr in all_instrs:
         if len(instr) > 3 and instr[3] == 'SPECIAL':
             if instr[0] == 'STORE_RETURN_ADDR':
                 # Store return address (instruction after the jump)
@@ -1385,29 +1475,16 @@ def assemble(filepath):
                 return_addr = len(resolved_instrs) + 2  # After SET D and PUSH RETURN D
                 
                 # Generate: SET D TO return_addr, PUSH RETURN D
-                resolved_instrs.append((0, REGISTERS['D'], return_addr & 0xFF, OPCODES['SET']))
-                # PUSH RETURN D (push register D to RETURN stack)
-                data3 = (STACK_OPS['PUSH'] << 2) | STACK_TYPES['RETURN']
-                data2 = (0 << 4) | REGISTERS['D']  # extype=0, reg=D
-                resolved_instrs.append((data3, data2, 0, OPCODES['STACK']))
+                resolved_instrs.append((0, reg_d, return_addr & 0xFF, OP_SET))
+                resolved_instrs.append(PUSH_RETURN_D)
             elif instr[0] == 'RETURN':
                 # Return instruction: Pop return address from stack and jump to it
-                
-                # Generate: POP RETURN D, JUMP D
-                # POP RETURN D (pop from RETURN stack to register D)
-                data3 = (STACK_OPS['POP'] << 2) | STACK_TYPES['RETURN']
-                data2 = (0 << 4) | REGISTERS['D']  # extype=0, reg=D
-                resolved_instrs.append((data3, data2, 0, OPCODES['STACK']))
-                # JUMP D (jump to address in register D)
-                data3 = (1 << 4) | 0  # usereg=1, key=0
-                data2 = (REGISTERS['D'] << 4) | 0  # reg=D, jmptype=0 (unconditional)
-                resolved_instrs.append((data3, data2, 0, OPCODES['JUMP']))
+                resolved_instrs.extend(RETURN_INSTRS)
         else:
             resolved_instrs.append(instr)
     
     # Pad to 256 instructions
-    while len(resolved_instrs) < 256:
-        resolved_instrs.append((0, 0, 0, OPCODES['NOP']))
+    resolved_instrs.extend([NOP_INSTR] * (256 - len(resolved_instrs)))
 
     # Format for ROM1 and ROM2
     # ROM1 contains DATA1 + OPCODE
@@ -1415,163 +1492,66 @@ def assemble(filepath):
     
     rom1 = []
     rom2 = []
-    for instr in resolved_instrs:
+    # The validated program packed as 4 bytes per instruction: DATA3, DATA2, DATA1, OPCODE
+    program = bytearray()
+    last_real_instruction = -1  # Index of the last non-NOP instruction; trailing NOPs aren't listed
+    for index, instr in enumerate(resolved_instrs):
         if len(instr) == 4:
             data3, data2, data1, opcode = instr
-            # Validate data fields are within valid ranges
-            if not (0 <= data3 <= 255):
-                raise ValueError(f"DATA3 field out of range (0-255): {data3} in instruction {instr}")
-            if not (0 <= data2 <= 255):
-                raise ValueError(f"DATA2 field out of range (0-255): {data2} in instruction {instr}")
-            if not (0 <= data1 <= 255):
-                raise ValueError(f"DATA1 field out of range (0-255): {data1} in instruction {instr}")
-            if not (0 <= opcode <= 255):
-                raise ValueError(f"OPCODE field out of range (0-255): {opcode} in instruction {instr}")
-            
-            rom1.append(f"{data1:08b}{opcode:08b}")
-            rom2.append(f"{data3:08b}{data2:08b}")
+            # bytearray only accepts byte values, so packing the fields validates them all at
+            # once; the per-field checks only run to name the bad field when it fails
+            try:
+                program.extend(instr)
+            except (ValueError, TypeError):
+                if not (0 <= data3 <= 255):
+                    raise ValueError(f"DATA3 field out of range (0-255): {data3} in instruction {instr}")
+                if not (0 <= data2 <= 255):
+                    raise ValueError(f"DATA2 field out of range (0-255): {data2} in instruction {instr}")
+                if not (0 <= data1 <= 255):
+                    raise ValueError(f"DATA1 field out of range (0-255): {data1} in instruction {instr}")
+                if not (0 <= opcode <= 255):
+                    raise ValueError(f"OPCODE field out of range (0-255): {opcode} in instruction {instr}")
+                raise
+            rom1.append(BYTE_BITS[data1] + BYTE_BITS[opcode])
+            rom2.append(BYTE_BITS[data3] + BYTE_BITS[data2])
+            if opcode != OP_NOP:
+                last_real_instruction = index
         else:
             raise ValueError(f"ERROR: Malformed instruction detected: {instr}. All instructions must be 4-tuples (data3, data2, data1, opcode).")
     
-    
-        # Find the last non-NOP instruction
-    last_real_instruction = len(rom1) - 1
-    while last_real_instruction >= 0:
-        opcode = int(rom1[last_real_instruction][8:], 2)
-        if opcode != OPCODES['NOP']:
-            break
-        last_real_instruction -= 1
-    
     # Write to outputBinary.txt with ROM2 and ROM1 combined on each line, plus human-readable instruction
     with open("outputBinary.txt", "w") as f:
-        for i, (r2, r1) in enumerate(zip(rom2, rom1)):
+        # Lines are collected and written in one call at the end
+        output_lines = []
+        # Read the fields back from the packed program instead of reparsing the bit strings
+        fields = INSTRUCTION_STRUCT.iter_unpack(program)
+        for i, (r2, r1, (data3, data2, data1, opcode)) in enumerate(zip(rom2, rom1, fields)):
             # Skip trailing NOPs
             if i > last_real_instruction:
                 break
-                
-            # Parse the binary data back into components
-            data3 = int(r2[:8], 2)
-            data2 = int(r2[8:], 2)
-            data1 = int(r1[:8], 2)
-            opcode = int(r1[8:], 2)
             
             # Generate human-readable instruction based on opcode
-            instruction = ""
-            if opcode == OPCODES['NOP']:
-                instruction = "NOP"
-            elif opcode == OPCODES['HALT']:
-                instruction = "HALT"
-            elif opcode == OPCODES['ALU']:
-                # Extract components from data fields
-                reg1_nibble = (data3 >> 4) & 0xF
-                op_code = data3 & 0xF
-                reg2_type = (data2 >> 6) & 0x3
-                reg1_type = (data2 >> 4) & 0x3
-                out_reg = data2 & 0xF
-                reg2 = (data1 >> 4) & 0xF
-                reg1 = data1 & 0xF
-                
-                # Get register names
-                reg_names = {v: k for k, v in REGISTERS.items()}
-                out_reg_name = reg_names.get(out_reg, f"R{out_reg}")
-                
-                # Get operation name
-                op_names = {v: k for k, v in ALU_OPS.items()}
-                op_name = op_names.get(op_code, f"OP{op_code}")
-                
-                # Format operands based on type
-                def format_operand(reg_val, reg_type):
-                    if reg_type == VALUE_TYPES['REGISTER']:
-                        return reg_names.get(reg_val, f"R{reg_val}")
-                    elif reg_type == VALUE_TYPES['BUILTIN']:
-                        return str(reg_val)
-                    elif reg_type == VALUE_TYPES['RAM']:
-                        return f"[{reg_val}]"
-                    return f"?{reg_val}"
-                
-                reg1_str = format_operand(reg1, reg1_type)
-                reg2_str = format_operand(reg2, reg2_type)
-                
-                instruction = f"{out_reg_name} = {reg1_str} {op_name} {reg2_str}"
-            elif opcode == OPCODES['STORE']:
-                reg = data2
-                addr = data1
-                reg_name = next((k for k, v in REGISTERS.items() if v == reg), f"R{reg}")
-                instruction = f"STORE {reg_name} into [{addr}]"
-            elif opcode == OPCODES['LOAD']:
-                reg = data2
-                addr = data1
-                reg_name = next((k for k, v in REGISTERS.items() if v == reg), f"R{reg}")
-                instruction = f"LOAD [{addr}] into {reg_name}"
-            elif opcode == OPCODES['SET']:
-                reg = data2
-                value = data1
-                reg_name = next((k for k, v in REGISTERS.items() if v == reg), f"R{reg}")
-                instruction = f"SET {reg_name} to {value}"
-            elif opcode == OPCODES['JUMP']:
-                usereg = (data3 >> 4) & 0x1
-                key = data3 & 0xF
-                reg = (data2 >> 4) & 0xF
-                jmptype = data2 & 0xF
-                addr = data1
-                
-                # Get jump type name
-                jmp_types = {v: k for k, v in JUMP_TYPES.items()}
-                jmp_type_name = jmp_types.get(jmptype, "")
-                
-                if usereg:
-                    reg_name = next((k for k, v in REGISTERS.items() if v == reg), f"R{reg}")
-                    instruction = f"JUMP {reg_name}"
-                else:
-                    instruction = f"JUMP {addr}"
-                
-                if jmp_type_name:
-                    instruction += f" if {jmp_type_name}"
-                
-                if jmptype == JUMP_TYPES['KEY']:
-                    key_names = {v: k for k, v in KEYS.items()}
-                    key_name = key_names.get(key, f"KEY{key}")
-                    instruction += f" {key_name}"
-            elif opcode == OPCODES['DRAW']:
-                b = data3 & 0xF
-                r = (data2 >> 4) & 0xF
-                g = data2 & 0xF
-                y = (data1 >> 4) & 0xF
-                x = data1 & 0xF
-                instruction = f"DRAW {x} {y} {r} {g} {b}"
-            elif opcode == OPCODES['CLEARSCREEN']:
-                instruction = "CLEARSCREEN"
-            elif opcode == OPCODES['REFRESHSCREEN']:
-                instruction = "REFRESHSCREEN"
-            elif opcode == OPCODES['RANDOM']:
-                reg = data2
-                reg_name = next((k for k, v in REGISTERS.items() if v == reg), f"R{reg}")
-                instruction = f"RANDOM {reg_name}"
-            elif opcode == OPCODES['STACK']:
-                stack_op = (data3 >> 2) & 0x3
-                stack_type = data3 & 0x3
-                reg = data2 & 0xF
-                value = data1
-                
-                # Get stack operation and type names
-                stack_ops = {v: k for k, v in STACK_OPS.items()}
-                stack_types = {v: k for k, v in STACK_TYPES.items()}
-                
-                op_name = stack_ops.get(stack_op, f"OP{stack_op}")
-                stack_name = stack_types.get(stack_type, f"STACK{stack_type}")
-                
-                if reg == 0xF:  # No register, use value
-                    instruction = f"{op_name} {stack_name} {value}"
-                else:
-                    reg_name = next((k for k, v in REGISTERS.items() if v == reg), f"R{reg}")
-                    instruction = f"{op_name} {stack_name} {reg_name}"
+            fixed = FIXED_LISTINGS.get(opcode)
+            if fixed is not None:
+                instruction = fixed
             else:
-                instruction = f"UNKNOWN ({opcode})"
+                disassembler = DISASSEMBLERS.get(opcode)
+                if disassembler is not None:
+                    instruction = disassembler(data3, data2, data1)
+                else:
+                    instruction = f"UNKNOWN ({opcode})"
             
-            # Write binary data and instruction
-            f.write(f"{r2}{r1}  // {i:03d}: {instruction}\n")
+            # Binary data and instruction
+            output_lines.append(f"{r2}{r1}  // {i:03d}: {instruction}\n")
+        f.write("".join(output_lines))
 
-    # Output to clipboard
+    # Output to clipboard - pyperclip is only needed here, so it is imported late
+    # and the assembler still works where it isn't installed
+    try:
+        import pyperclip
+    except ImportError:
+        print("pyperclip is not installed; skipping clipboard copy.")
+        return
     pyperclip.copy("\n".join(rom1))
     input("ROM1 (DATA1 + OPCODE) copied to clipboard. Press Enter to copy ROM2...")
     pyperclip.copy("\n".join(rom2))